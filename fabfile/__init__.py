@@ -7,7 +7,7 @@ from fabric.api import env
 import system
 
 __all__ = [
-    'set_env', 'system', 'mysql', 'postfix', 'iojs'
+    'set_env', 'system', 'mysql', 'postfix', 'iojs', 'facts', 'fleet'
 ]
 
 
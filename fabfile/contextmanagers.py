@@ -1,21 +1,15 @@
 from fabric.api import cd, prefix  # , sudo as _sudo, run as _run, hide, task, get, put, settings
 from contextlib import contextmanager
-from functools import wraps
-from fabric.colors import green
+from .instrument import profiled
 
 
 def log_call(func):
     """
-    Pretty-print calls to functions.
+    Pretty-print and profile calls to functions; see instrument.profiled().
 
     This is actually a decorator, not a context manager, but whatever.
     """
-    @wraps(func)
-    def logged(*args, **kawrgs):
-        header = "-" * len(func.__name__)
-        print green("\n".join([header, func.__name__, header]), bold=True)
-        return func(*args, **kawrgs)
-    return logged
+    return profiled(func)
 
 
 @contextmanager
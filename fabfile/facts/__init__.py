@@ -0,0 +1,168 @@
+from fabric.api import env, task, hide
+from ..instrument import run
+import os
+import time
+import json
+
+__all__ = ['gather', 'show', 'get']
+
+# A single shell script that reports everything we want to know about the host, in sections
+# delimited by '== <name>' lines. Every section is optional; a missing tool just yields an
+# empty section.
+GATHER_SCRIPT = """
+echo '== hostname'; hostname
+echo '== fqdn'; hostname -f 2>/dev/null
+echo '== cpus'; nproc 2>/dev/null || grep -c ^processor /proc/cpuinfo
+echo '== meminfo'; grep -E '^(MemTotal|SwapTotal):' /proc/meminfo
+echo '== os-release'; cat /etc/os-release 2>/dev/null
+echo '== addr'; /sbin/ip -o addr show 2>/dev/null
+echo '== route'; /sbin/ip -4 route show default 2>/dev/null
+echo '== packages'; dpkg-query -W -f='${Package} ${Version}\\n' 2>/dev/null
+true
+"""
+
+# facts already loaded in this run, keyed by host string
+_facts = {}
+
+
+def _cache_path(host):
+    """
+    Return the local path of the facts cache file for the specified host.
+    """
+    root = os.path.expanduser(getattr(env, 'cotton_cache_path', None) or '~/.cotton')
+    return os.path.join(root, 'facts', host.replace('/', '_') + '.json')
+
+
+def _split_sections(out):
+    """
+    Split the output of GATHER_SCRIPT into a dict of {section name: [lines]}.
+    """
+    sections = {}
+    current = None
+    for line in out.splitlines():
+        line = line.rstrip()
+        if line.startswith('== '):
+            current = sections.setdefault(line[3:], [])
+        elif current is not None and line:
+            current.append(line)
+    return sections
+
+
+def parse(out):
+    """
+    Parse the output of GATHER_SCRIPT into a dict of facts.
+    """
+    s = _split_sections(out)
+    first = lambda k, default=None: s.get(k) and s[k][0].strip() or default
+
+    facts = {
+        'hostname': first('hostname'),
+        'fqdn': first('fqdn'),
+        'cpus': int(first('cpus', '0') or 0),
+        'memory_kb': 0,
+        'swap_kb': 0,
+        'distro': {},
+        'interfaces': {},
+        'default_iface': None,
+        'packages': {},
+        'gathered_at': time.time(),
+    }
+
+    for line in s.get('meminfo', []):
+        (k, v) = line.split(':', 1)
+        facts['memory_kb' if k == 'MemTotal' else 'swap_kb'] = int(v.split()[0])
+
+    for line in s.get('os-release', []):
+        if '=' in line:
+            (k, v) = line.split('=', 1)
+            facts['distro'][k.lower()] = v.strip('"')
+
+    # sample: 2: eth0    inet 10.0.0.5/24 brd 10.0.0.255 scope global eth0\       valid_lft ...
+    for line in s.get('addr', []):
+        parts = line.split()
+        if len(parts) < 4 or parts[2] not in ('inet', 'inet6'):
+            continue
+        iface = facts['interfaces'].setdefault(parts[1], {'ipv4': [], 'ipv6': []})
+        iface['ipv4' if parts[2] == 'inet' else 'ipv6'].append(parts[3])
+
+    # sample: default via 10.0.0.1 dev eth0 onlink
+    for line in s.get('route', []):
+        parts = line.split()
+        if 'dev' in parts:
+            facts['default_iface'] = parts[parts.index('dev') + 1]
+            break
+
+    for line in s.get('packages', []):
+        parts = line.split()
+        if len(parts) == 2:
+            facts['packages'][parts[0]] = parts[1]
+
+    return facts
+
+
+def _publish(facts):
+    """
+    Expose the facts for the current host on the env.
+    """
+    env.facts = facts
+    env.hostname = facts['hostname']
+    iface = getattr(env, 'public_iface', None) or facts['default_iface']
+    addrs = facts['interfaces'].get(iface, {}).get('ipv4', [])
+    env.public_ip = addrs[0].split('/')[0] if addrs else None
+    return facts
+
+
+def get(refresh=False):
+    """
+    Return the facts for the current host, gathering them only if no cached copy exists or the
+    cached copy is older than FACTS_TTL seconds.
+    """
+    host = env.host_string
+    facts = None if refresh else _facts.get(host)
+
+    path = _cache_path(host)
+    ttl = getattr(env, 'facts_ttl', 3600)
+    if not facts and not refresh and os.path.exists(path):
+        if time.time() - os.path.getmtime(path) < ttl:
+            with open(path, 'r') as f:
+                facts = json.load(f)
+
+    if not facts:
+        with hide('running', 'stdout'):
+            facts = parse(run(GATHER_SCRIPT, shell=True, label='facts'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump(facts, f, indent=2, sort_keys=True)
+
+    _facts[host] = facts
+    return _publish(facts)
+
+
+def forget():
+    """
+    Discard the facts for the current host, so that the next call to get() gathers them anew.
+    Tasks that change the host (installing packages, for example) should call this.
+    """
+    _facts.pop(env.host_string, None)
+    path = _cache_path(env.host_string)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@task
+def gather():
+    """
+    Gather (or refresh) the facts for each host and cache them locally
+    """
+    return get(refresh=True)
+
+
+@task
+def show():
+    """
+    Display the facts for each host
+    """
+    facts = dict(get())
+    facts['packages'] = len(facts['packages'])
+    print json.dumps(facts, indent=2, sort_keys=True)
@@ -0,0 +1,173 @@
+from fabric.api import env, task, runs_once, abort
+from fabric import state
+from fabric.tasks import execute
+from fabric.task_utils import crawl
+from fabric.network import disconnect_all
+from multiprocessing import Process, Queue
+from Queue import Empty
+import cPickle as pickle
+import traceback
+import time
+from .. import instrument
+
+__all__ = ['rollout']
+
+
+def _truthy(value):
+    """
+    Interpret a task argument from the fab command line as a boolean.
+    """
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'y', 'yes', 'true', 'on')
+    return bool(value)
+
+
+def _count(value, total):
+    """
+    Resolve an absolute count or a percentage string (eg. '25%') against a total.
+    """
+    if value is None:
+        return None
+    value = str(value)
+    if value.endswith('%'):
+        return max(1, int(total * float(value[:-1]) / 100))
+    return int(value)
+
+
+def _worker(func, host, args, kwargs, queue):
+    """
+    Execute func against a single host in a forked child, and report the outcome to the parent.
+    """
+
+    # the parent's cached connections are not ours to use; we'll open our own.
+    state.connections.clear()
+    instrument.reset()
+
+    start = time.time()
+    outcome = {'host': host, 'status': 'ok', 'error': None, 'result': None}
+    try:
+        result = execute(func, *args, hosts=[host], **kwargs)[host]
+        try:
+            pickle.dumps(result)
+            outcome['result'] = result
+        except Exception:
+            outcome['result'] = repr(result)
+    except BaseException as e:
+        outcome['status'] = 'failed'
+        outcome['error'] = str(e) or e.__class__.__name__
+        traceback.print_exc()
+    finally:
+        disconnect_all()
+    outcome['duration'] = time.time() - start
+    outcome['profile'] = instrument.results()
+    queue.put(outcome)
+
+
+def schedule(func, hosts=None, concurrency=None, batch=None, fail_fast=None, max_failures=None,
+             timeout=None, *args, **kwargs):
+    """
+    Run func against many hosts, in rolling batches of parallel workers.
+
+    Hosts are split into batches of batch hosts (an absolute count, or a percentage of the
+    fleet like '25%'); within a batch, up to concurrency hosts run at once, each in its own
+    process. A host that runs longer than timeout seconds is killed and counted as a failure.
+    The rollout stops as soon as any host has failed if fail_fast is set, or as soon as more
+    than max_failures hosts (again, a count or a percentage) have failed: no further hosts are
+    started, even within the current batch, and those already running are left to finish.
+    Hosts that were never started are reported as 'skipped'.
+
+    Returns a list of per-host outcome dicts, in the order the hosts were given.
+    """
+    hosts = list(hosts or env.hosts)
+    concurrency = int(concurrency or getattr(env, 'fleet_concurrency', None) or 1)
+    batch = _count(batch or getattr(env, 'fleet_batch', None), len(hosts)) or len(hosts)
+    fail_fast = _truthy(fail_fast if fail_fast is not None
+                        else getattr(env, 'fleet_fail_fast', False))
+    max_failures = _count(max_failures if max_failures is not None
+                          else getattr(env, 'fleet_max_failures', None), len(hosts))
+    timeout = float(timeout or getattr(env, 'fleet_timeout', None) or 0)
+
+    outcomes = dict([(h, {'host': h, 'status': 'skipped', 'error': None, 'duration': 0.0})
+                     for h in hosts])
+    queue = Queue()
+
+    def failures():
+        return len([o for o in outcomes.values() if o['status'] not in ('ok', 'skipped')])
+
+    def stopping():
+        n = failures()
+        return n and (fail_fast or (max_failures is not None and n > max_failures))
+
+    for i in range(0, len(hosts), batch):
+        pending = hosts[i:i + batch]
+        running = {}
+        while pending or running:
+
+            # no new hosts are started once we are stopping; those already running may finish.
+            if pending and stopping():
+                pending = []
+            while pending and len(running) < concurrency:
+                host = pending.pop(0)
+                p = Process(target=_worker, args=(func, host, args, kwargs, queue))
+                p.start()
+                running[host] = (p, time.time())
+
+            try:
+                outcome = queue.get(timeout=0.2)
+                instrument.merge(outcome.pop('profile'))
+
+                # a host already given up on (timed out or crashed) keeps that outcome.
+                entry = running.pop(outcome['host'], None)
+                if entry:
+                    outcomes[outcome['host']] = outcome
+                    entry[0].join()
+            except Empty:
+                pass
+
+            now = time.time()
+            for (host, (p, started)) in running.items():
+                if timeout and now - started > timeout:
+                    p.terminate()
+                    outcomes[host] = {'host': host, 'status': 'timeout', 'duration': now - started,
+                                      'error': 'killed after %ss' % timeout}
+                elif p.exitcode is not None and now - started > 1 and queue.empty():
+                    outcomes[host] = {'host': host, 'status': 'crashed', 'duration': now - started,
+                                      'error': 'worker exited with code %s' % p.exitcode}
+                else:
+                    continue
+                p.join()
+                running.pop(host, None)
+
+        if stopping():
+            print "Stopping rollout after %d failure(s)." % failures()
+            break
+
+    results = [outcomes[h] for h in hosts]
+    summary(results)
+    return results
+
+
+def summary(outcomes):
+    """
+    Print a table of per-host outcomes and durations.
+    """
+    print
+    print "%-40s %-8s %9s  %s" % ('host', 'status', 'duration', 'error')
+    for o in outcomes:
+        print "%-40s %-8s %8.1fs  %s" % (o['host'], o['status'], o['duration'], o['error'] or '')
+    print
+
+
+@task
+@runs_once
+def rollout(name, concurrency=None, batch=None, fail_fast=None, max_failures=None, timeout=None):
+    """
+    Run a task across HOSTS in rolling, parallel batches; eg. fleet.rollout:ship,batch=25%
+    """
+    func = crawl(name, state.commands)
+    if not func:
+        abort("No such task: %s" % name)
+
+    results = schedule(func, env.hosts, concurrency, batch, fail_fast, max_failures, timeout)
+    if [o for o in results if o['status'] != 'ok']:
+        abort("Rollout of %s did not complete on every host." % name)
@@ -0,0 +1,116 @@
+"""
+Run a declared graph of dependent steps against the current host, concurrently where possible.
+"""
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+from fabric.api import abort
+from fabric import state
+from fabric.network import disconnect_all
+from . import instrument
+
+
+def _critical_path(steps, timings):
+    """
+    Return the chain of steps, ending with the last to finish, in which each step's start was
+    bounded by the step before it.
+    """
+    by_name = dict([(s['name'], s) for s in steps])
+    name = max(timings, key=lambda n: timings[n]['end'])
+    path = [name]
+    while by_name[name].get('requires'):
+        name = max(by_name[name]['requires'], key=lambda n: timings[n]['end'])
+        path.insert(0, name)
+    return path
+
+
+def _worker(step, queue):
+    """
+    Run a single step in a forked child, and report the outcome to the parent.
+    """
+
+    # the parent's cached connections are not ours to use; we'll open our own.
+    state.connections.clear()
+    instrument.reset()
+    instrument.detach_stack()
+
+    start = time.time()
+    error = None
+    try:
+        step['func']()
+    except BaseException as e:
+        error = str(e) or e.__class__.__name__
+    finally:
+        disconnect_all()
+    queue.put((step['name'], start, time.time(), error,
+               instrument.results(), instrument.stack_counters()))
+
+
+def execute(steps, concurrency=4):
+    """
+    Execute a list of steps, each started as soon as all the steps it requires have finished.
+
+    Each step is a dict with the keys 'name', 'func' (called with no arguments) and, optionally,
+    'requires' (a list of step names). Up to concurrency steps run at once, each in its own
+    forked process with its own connection to the host, so that the settings() and hide()
+    changes one step makes to fabric's env cannot leak into another; by the same token, changes
+    a step makes to env are not seen by the steps that follow it.
+
+    The first failing step aborts the run once the steps already in flight have finished.
+    Returns a dict of {name: {'start', 'end', 'duration'}}, and prints the critical path.
+    """
+    names = [s['name'] for s in steps]
+    for s in steps:
+        for r in s.get('requires', []):
+            if r not in names:
+                raise Exception("Step %s requires unknown step %s" % (s['name'], r))
+
+    parent = instrument.current_stack()
+    done = Queue()
+    timings = {}
+    failures = {}
+    pending = list(steps)
+    running = {}
+
+    while pending or running:
+        ready = [
+            s for s in pending
+            if not failures and set(s.get('requires', [])) <= set(timings)
+        ]
+        for s in ready[:max(concurrency - len(running), 0)]:
+            pending.remove(s)
+            running[s['name']] = Process(target=_worker, args=(s, done), name=s['name'])
+            running[s['name']].start()
+
+        if not running:
+            break
+
+        # a worker flushes its outcome before exiting, so one that had already exited before we
+        # waited, yet reported nothing, has crashed.
+        exited = [n for (n, p) in running.items() if p.exitcode is not None]
+        try:
+            (name, start, end, error, profile, counters) = done.get(timeout=0.2)
+        except Empty:
+            for name in exited:
+                failures[name] = "exited with code %s" % running[name].exitcode
+                running.pop(name).join()
+            continue
+
+        instrument.merge(profile)
+        instrument.add_stack_counters(parent, counters)
+        running.pop(name).join()
+        if error:
+            failures[name] = error
+        else:
+            timings[name] = {'start': start, 'end': end, 'duration': end - start}
+
+    if failures:
+        abort("Failed steps: %s" % ", ".join(
+            ["%s (%s)" % (n, e) for (n, e) in failures.items()]))
+
+    path = _critical_path(steps, timings)
+    origin = min([t['start'] for t in timings.values()])
+    print "Critical path (%.1fs): %s" % (
+        timings[path[-1]]['end'] - origin,
+        " -> ".join(["%s (%.1fs)" % (n, timings[n]['duration']) for n in path]))
+    return timings
@@ -0,0 +1,286 @@
+"""
+Per-task, per-host instrumentation.
+
+Tasks decorated with profiled() (util.print_header and contextmanagers.log_call are aliases) are
+timed, and every remote command or transfer issued through the run/sudo/put/get wrappers here is
+attributed to the innermost running task on the current host: the number of commands, the time
+spent waiting on each, and the bytes sent and received.
+
+If PROFILE_PATH is set, the results are written at exit to PROFILE_PATH.json, and as collapsed
+stacks (host;task;subtask;command) to PROFILE_PATH.folded, suitable for flamegraph.pl.
+"""
+import os
+import time
+import json
+import atexit
+import threading
+import subprocess
+from functools import wraps
+from contextlib import contextmanager
+from collections import defaultdict
+from fabric.api import env, run as _run, sudo as _sudo, put as _put, get as _get
+from fabric.colors import green
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# completed task records, and the individual commands issued by them
+_tasks = []
+_commands = []
+
+# collapsed stack => milliseconds of self time
+_stacks = defaultdict(float)
+
+# the per-task counters accumulated by the commands and subtasks it runs
+COUNTERS = ('commands', 'wait', 'bytes_up', 'bytes_down', 'children')
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_stack():
+    """
+    Return a copy of the current thread's task stack, for handing to add_stack_counters().
+    """
+    return list(_stack())
+
+
+def detach_stack():
+    """
+    In a forked worker, replace the inherited task stack with copies whose counters are zeroed,
+    so that stack_counters() returns only what the worker has recorded against them.
+    """
+    _local.stack = [dict(f, **dict.fromkeys(COUNTERS, 0)) for f in _stack()]
+
+
+def stack_counters():
+    """
+    Return the counters of each task on the current stack.
+    """
+    return [dict([(k, f[k]) for k in COUNTERS]) for f in _stack()]
+
+
+def add_stack_counters(stack, counters):
+    """
+    Add the stack_counters() of a forked worker to the tasks in stack, the parent's tasks from
+    which the worker's were detached.
+    """
+    with _lock:
+        for (frame, c) in zip(stack, counters):
+            for k in COUNTERS:
+                frame[k] += c[k]
+
+
+def _host():
+    return env.host_string or 'localhost'
+
+
+def _path(leaf=None):
+    names = [f['task'] for f in _stack()]
+    if leaf:
+        names.append(leaf)
+    return ';'.join([_host()] + names)
+
+
+def category(command):
+    """
+    Return the program a shell command invokes, ignoring sudo and leading variable assignments.
+    """
+    for word in command.split():
+        if word in ('sudo', 'env', '-n', '-H') or '=' in word:
+            continue
+        return os.path.basename(word.strip('"\'('))
+    return 'sh'
+
+
+def _record(label, wait, sent, received):
+    """
+    Attribute a completed command to every task on the current stack.
+    """
+    with _lock:
+        for frame in _stack():
+            frame['commands'] += 1
+            frame['wait'] += wait
+            frame['bytes_up'] += sent
+            frame['bytes_down'] += received
+        if _stack():
+            _stack()[-1]['children'] += wait
+        _stacks[_path(label)] += wait * 1000
+        _commands.append({
+            'host': _host(),
+            'stack': [f['task'] for f in _stack()],
+            'command': label,
+            'wait': wait,
+            'bytes_up': sent,
+            'bytes_down': received,
+        })
+
+
+@contextmanager
+def command(label, sent=0):
+    """
+    Time a single command or transfer. The yielded dict's 'received' member may be updated with
+    the number of bytes received before the block exits.
+    """
+    stats = {'received': 0}
+    start = time.time()
+    try:
+        yield stats
+    finally:
+        _record(label, time.time() - start, sent, stats['received'])
+
+
+def run(cmd, *args, **kwargs):
+    """
+    Instrumented fabric.api.run.
+    """
+    with command(kwargs.pop('label', None) or category(cmd), sent=len(cmd)) as stats:
+        out = _run(cmd, *args, **kwargs)
+        stats['received'] = len(out)
+    return out
+
+
+def sudo(cmd, *args, **kwargs):
+    """
+    Instrumented fabric.api.sudo.
+    """
+    with command(kwargs.pop('label', None) or category(cmd), sent=len(cmd)) as stats:
+        out = _sudo(cmd, *args, **kwargs)
+        stats['received'] = len(out)
+    return out
+
+
+def put(local_path, remote_path=None, *args, **kwargs):
+    """
+    Instrumented fabric.api.put; local_path may be a path or a file-like object.
+    """
+    if hasattr(local_path, 'seek'):
+        local_path.seek(0, 2)
+        size = local_path.tell()
+        local_path.seek(0)
+    else:
+        size = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+    with command('put', sent=size):
+        return _put(local_path, remote_path, *args, **kwargs)
+
+
+def get(remote_path, local_path=None, *args, **kwargs):
+    """
+    Instrumented fabric.api.get.
+    """
+    with command('get') as stats:
+        ret = _get(remote_path, local_path, *args, **kwargs)
+        stats['received'] = sum([
+            os.path.getsize(p) for p in ret if isinstance(p, basestring) and os.path.isfile(p)
+        ])
+    return ret
+
+
+def check_call(args, **kwargs):
+    """
+    Instrumented subprocess.check_call, for local commands that talk to the remote host.
+    """
+    with command(os.path.basename(args[0]) + ' (local)'):
+        return subprocess.check_call(args, **kwargs)
+
+
+def profiled(func):
+    """
+    Function decorator that displays the function name as a header in the output, and records
+    the wall time, commands and bytes transferred for each invocation on each host.
+    """
+    module = func.__module__.split('.')[-1]
+    name = func.__name__ if module in ('fabfile', '__main__') else module + '.' + func.__name__
+
+    @wraps(func)
+    def logged(*args, **kwargs):
+        header = "-" * len(func.__name__)
+        print(green("\n".join([header, func.__name__, header]), bold=True))
+
+        frame = {
+            'task': name, 'host': _host(), 'started': time.time(),
+            'commands': 0, 'wait': 0.0, 'bytes_up': 0, 'bytes_down': 0, 'children': 0.0,
+        }
+        _stack().append(frame)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            frame['wall'] = time.time() - frame['started']
+            with _lock:
+                _stacks[_path()] += max(frame['wall'] - frame['children'], 0) * 1000
+                _stack().pop()
+                if _stack():
+                    _stack()[-1]['children'] += frame['wall']
+                frame['parent'] = _stack()[-1]['task'] if _stack() else None
+                del frame['children']
+                _tasks.append(frame)
+    return logged
+
+
+def results():
+    """
+    Return everything recorded so far, as a JSON-serializable dict.
+    """
+    with _lock:
+        return {
+            'tasks': list(_tasks),
+            'commands': list(_commands),
+            'stacks': dict(_stacks),
+        }
+
+
+def reset():
+    """
+    Discard everything recorded so far; eg. in a freshly forked per-host worker.
+    """
+    with _lock:
+        del _tasks[:]
+        del _commands[:]
+        _stacks.clear()
+
+
+def merge(data):
+    """
+    Merge results() from another process (eg. a forked per-host worker) into our own.
+    """
+    with _lock:
+        _tasks.extend(data['tasks'])
+        _commands.extend(data['commands'])
+        for (k, v) in data['stacks'].items():
+            _stacks[k] += v
+
+
+def write(path):
+    """
+    Write the results to <path>.json and <path>.folded.
+    """
+    data = results()
+    with open(path + '.json', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    with open(path + '.folded', 'w') as f:
+        for (stack, ms) in sorted(data['stacks'].items()):
+            if int(ms):
+                f.write("%s %d\n" % (stack, int(ms)))
+
+
+def summary():
+    """
+    Print the time each top-level task took on each host, split into remote wait and overhead.
+    """
+    print "%-30s %-30s %9s %9s %6s %10s %10s" % (
+        'host', 'task', 'wall', 'wait', 'cmds', 'up', 'down')
+    for t in [t for t in _tasks if not t['parent']]:
+        print "%-30s %-30s %8.2fs %8.2fs %6d %10d %10d" % (
+            t['host'], t['task'], t['wall'], t['wait'], t['commands'], t['bytes_up'],
+            t['bytes_down'])
+
+
+@atexit.register
+def _report():
+    path = getattr(env, 'profile_path', None)
+    if path and _tasks:
+        write(os.path.expanduser(path))
+        summary()
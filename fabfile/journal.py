@@ -0,0 +1,111 @@
+"""
+A per-host journal of the inputs to each step cotton has applied.
+
+Each step records a digest of its inputs under JOURNAL_PATH on the host once it has been applied
+successfully. On later runs, a step whose inputs hash to the recorded digest is skipped, unless
+FORCE is set (eg. fab --set force=1 ...) or COTTON_FORCE is present in the environment.
+"""
+import os
+import json
+import hashlib
+from functools import wraps
+from pipes import quote
+from fabric.api import env, hide
+from .instrument import sudo
+
+# {host_string: {step: digest}}
+_journals = {}
+
+
+def _path():
+    return getattr(env, 'journal_path', None) or '/var/lib/cotton/journal'
+
+
+def forced():
+    """
+    Return True if journalled steps should be re-applied regardless of their inputs.
+    """
+    force = getattr(env, 'force', False) or os.environ.get('COTTON_FORCE')
+    return bool(force) and str(force).lower() not in ('0', 'false', 'no')
+
+
+def digest(*inputs):
+    """
+    Return a digest of the specified inputs, which may be any JSON-serializable values.
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=repr)).hexdigest()
+
+
+def load(refresh=False):
+    """
+    Return the journal for the current host, reading it in a single command if necessary.
+    """
+    host = env.host_string
+    if refresh or host not in _journals:
+        with hide("running", "stdout"):
+            out = sudo("mkdir -p %s && cd %s && grep -H . * 2>/dev/null; true" % (
+                _path(), _path()), label="journal")
+        journal = {}
+        for line in out.splitlines():
+            (name, _, value) = line.strip().partition(":")
+            if value:
+                journal[name] = value
+        _journals[host] = journal
+    return _journals[host]
+
+
+def is_current(name, value):
+    """
+    Return True if the step was last applied with inputs matching the specified digest.
+    """
+    return not forced() and load().get(name) == value
+
+
+def record(name, value):
+    """
+    Record that the step has been applied with inputs matching the specified digest.
+    """
+    record_all({name: value})
+
+
+def record_all(entries):
+    """
+    Record several {step: digest} entries at once, in a single command.
+    """
+    if not entries:
+        return
+    with hide("running", "stdout"):
+        sudo(" && ".join(["mkdir -p %s" % _path()] + [
+            "echo %s > %s/%s" % (quote(value), _path(), name)
+            for (name, value) in sorted(entries.items())
+        ]), label="journal")
+    load().update(entries)
+
+
+def forget(name):
+    """
+    Remove a step from the journal, so that it is applied on the next run.
+    """
+    with hide("running", "stdout"):
+        sudo("rm -f %s/%s" % (_path(), name), label="journal")
+    load().pop(name, None)
+
+
+def converges(name, inputs):
+    """
+    Function decorator that skips the function if it has already been applied to the current host
+    with the same inputs; inputs is called with the function's arguments, and should return the
+    values the function's effect depends upon.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            value = digest(name, inputs(*args, **kwargs))
+            if is_current(name, value):
+                print "%s is unchanged since it was last applied; skipping." % name
+                return None
+            result = func(*args, **kwargs)
+            record(name, value)
+            return result
+        return wrapped
+    return decorator
@@ -1,17 +1,29 @@
 import os
-from subprocess import check_output, check_call
-from fabric.api import env, task, cd, settings, put
+import re
+import fcntl
+import time
+import shutil
+import tempfile
+import pkg_resources
+from StringIO import StringIO
+from pipes import quote
+from subprocess import check_output, call
+from fabric.api import env, task, cd, hide, runs_once, execute, abort
+from fabric.network import normalize
 from fabric.contrib.files import exists
-from .. import util, system
+from .. import util, system, ssh, fleet, journal
+from ..instrument import check_call, put, get
 from .. contextmanagers import project  # , log_call, virtualenv
 
 __all__ = [
     'create', 'install', 'remove', 'remove_templates',
-    'git_push', 'get_git_remotes', 'create_user', 'pip'
+    'git_push', 'get_git_remotes', 'create_user', 'pip', 'set_permissions', 'distribute',
+    'rollback', 'build_wheelhouse', 'read_requirements', 'ship_artifact', 'gc'
 ]
 
 
 @task
+@util.print_header
 def remove():
     """
     Blow away the current project
@@ -32,6 +44,7 @@ def remove_templates():
 
 
 @task
+@util.print_header
 def git_push(rev=None):
     """
     Push the local git repo to the remote hosts
@@ -42,33 +55,33 @@ def git_push(rev=None):
     if rev is None:
         rev = env.git_branch
 
+    if _use_releases():
+        return _push_release(rev)
+
     # ensure the project path exists and is an initialiezd git repo.
     if not exists(env.project_root):
         raise Exception(
             "The project root is missing! Do you need to run the install() task?")
 
+    # Pushed objects are made group-writable by git itself (core.sharedRepository), so the
+    # full permissions sweep is only needed after the first push to a new repository.
     u = env.user
     env.user = env.ssh_user
-    with cd(env.project_root):
-        system.run("git init")
-        system.run("git config --add receive.denyCurrentBranch ignore")
-        set_permissions()
-
-    remotes = get_git_remotes()
+    with system.batch():
+        with cd(env.project_root):
+            old = system.run("git rev-parse --verify -q HEAD || true")
+            system.run("git init")
+            system.run("git config --add receive.denyCurrentBranch ignore")
+            system.run("git config core.sharedRepository group")
+            share_objects()
+    old = old.stdout.strip()
 
-    # deprecated; see function docstring
-    # define_local_git_ssh()
+    # local git pushes reuse a persistent, multiplexed ssh connection to the host.
+    ssh_env = ssh.local_env()
 
-    # Set up the remote host as a git remote in our local configuration
-    #
-    # WAT: By only executing this sequence if the host is not listed in the remotes,
-    # deployments will break if we change either the user or project root.
-    # Needs fixin.
-    h = env.host_string
-    if h not in remotes:
-        util.print_command("git remote add %s %s@%s:%s" % (h, env.user, h, env.project_root))
-        check_call(["git", "remote", "add", h, "%s@%s:%s" % (env.user, h, env.project_root)])
-        remotes = get_git_remotes()
+    # Push straight to the host's URL, rather than registering it as a remote in our local
+    # configuration; that way changes to the user or project root are always honoured.
+    h = _git_url()
 
     # A little git jazz-hands here, to manage the push by first checking to see if
     # the default branch exists in the remote repository.
@@ -79,31 +92,37 @@ def git_push(rev=None):
             ret = system.run("git branch")
             if rev not in ret:
                 util.print_command("git push %s %s" % (h, rev))
-                check_call(["git", "push", h, rev])
+                check_call(["git", "push", h, rev], env=ssh_env)
                 pushed = True
 
     # The first push must create the master branch, so we must only specify the rev,
     # not the source ref. Because git reasons...
     if not pushed:
         util.print_command("git push %s HEAD:%s" % (h, rev))
-        check_call(["git", "push", h, "HEAD:%s" % rev])
+        check_call(["git", "push", h, "HEAD:%s" % rev], env=ssh_env)
 
     # ...but pushing into a branch on a remote that already exists will cause madness;
     # we must ensure the working tree is in sync with the newly-pushed ref.
-    with cd(env.project_root):
-        system.run("git checkout %s" % rev)
-        system.run("git reset --hard")  # weeeeee!
-        system.run("git submodule init")
-        system.run("git submodule update")
+    with system.batch():
+        with cd(env.project_root):
+            system.run("git checkout %s" % rev)
+            system.run("git reset --hard")  # weeeeee!
+            system.run("git submodule init")
+            system.run("git submodule update")
+            _publish_objects()
 
-        # fix up the permissions immediately after completing the push, so we don't
-        # try to interact with files we cannot read or modify.
+            # fix up the permissions of everything the push changed immediately, so we don't
+            # try to interact with files we cannot read or modify.
+            if old:
+                set_changed_permissions(old)
+    if not old:
         set_permissions()
 
     env.user = u
 
 
 @task
+@util.print_header
 def create():
     """
     (re)create a virtualenv for a python project deployment
@@ -121,6 +140,10 @@ def create():
     # great project.
     with cd(env.virtualenv_home):
 
+        # the requirements the virtualenv will be built with, while the old project is there to
+        # be read.
+        requirements = _pending_requirements()
+
         # remove the existing virtual environment and project root, if any.
         if exists(env.project_name):
             if not env.no_prompts:
@@ -131,12 +154,17 @@ def create():
                     return False
             remove()
 
-        # create the new virtualenv and project root
-        system.sudo("virtualenv %s" % env.project_name)
-        system.sudo("mkdir -p %s" % env.project_root)
+        # create the new virtualenv (from the cache, if we can) and project root; with
+        # USE_RELEASES, the project root is a symlink created by the first push.
+        if not clone_virtualenv(requirements):
+            system.sudo("virtualenv %s" % env.project_name)
+        if _use_releases():
+            system.sudo("mkdir -p %s" % _releases_path())
+        else:
+            system.sudo("mkdir -p %s" % env.project_root)
         set_permissions()
 
-    with cd(env.project_root):
+    with cd(env.virtualenv_path if _use_releases() else env.project_root):
 
         # do the initial configuration of the git client, so that we can do our
         # push unmolested.
@@ -150,18 +178,84 @@ def create():
             ))
             git_push()
         else:
+            ship_artifact()
 
-            # WAT not sure I ever want to re-implement flat-file support, tbqh.
-            raise NotImplementedError(
-                "flat-file support not implemented at this time.")
-            #root = os.path.dirname(os.path.abspath(__file__))
-            #system.sudo("mkdir -p %s" % env.project_root)
-            # for target in env.upload_targets:
-            #    put("%s/%s" %
-            #        (root, target), env.project_root, use_sudo=True, mirror_local_mode=True)
+
+@task
+@util.print_header
+def ship_artifact(rev=None):
+    """
+    Ship the project as a file tree rather than a git repository, for USE_GIT = False
+
+    The tree is ARTIFACT_PATH, if set (eg. the output of a build), otherwise a git archive of
+    the specified revision (GIT_BRANCH by default). The first time, it is streamed to the host
+    as a compressed tarball and unpacked on the fly. After that, rsync sends only the blocks
+    that differ from the tree already on the host. With USE_RELEASES, each shipment is a new
+    release: unchanged files are hardlinked from the previous one (--link-dest) before the
+    project root is switched to it.
+    """
+    if rev is None:
+        rev = env.git_branch
+    path = getattr(env, 'artifact_path', None)
+    if path:
+        name = time.strftime("build-%Y%m%d%H%M%S")
+        tar = "tar -cf - -C %s ." % quote(path)
+    else:
+        name = check_output(["git", "rev-parse", rev + "^{commit}"]).strip()
+        tar = "git archive --format=tar %s" % name
+
+    u = env.user
+    env.user = env.ssh_user
+    owner = "%s:%s" % (env.project_user, env.project_group)
+    if _use_releases():
+        prev = _current_release()
+        system.sudo("mkdir -p %s" % _releases_path())
+        dest = "%s/%s" % (_releases_path(), name)
+    else:
+        prev = None
+        dest = env.project_root
+    with hide("output"):
+        fresh = not system.run("ls -A %s 2>/dev/null | head -1" % (
+            "%s/%s" % (_releases_path(), prev) if prev else dest), show=False).strip()
+
+    ssh_env = ssh.local_env()
+    rsh = "%s -p %s" % (ssh.wrapper(), env.port or 22)
+    target = "%s@%s" % (env.user, env.host)
+    if fresh:
+        unpack = "sudo -n sh -c %s" % quote("mkdir -p %s && tar -xzf - --no-same-owner -C %s" % (
+            dest, dest))
+        pipeline = "%s | gzip -c | %s %s %s" % (tar, rsh, target, quote(unpack))
+        util.print_command(pipeline)
+        check_call(["bash", "-o", "pipefail", "-c", pipeline], env=ssh_env)
+        set_permissions()
+    else:
+        # without times, git archive's mtimes would defeat rsync's quick check; compare checksums.
+        args = ["rsync", "-rlpc", "--delete", "-e", rsh, "--rsync-path", "sudo -n rsync",
+                "--chown", owner, "--chmod", "D2775,Fug+rw"]
+        if prev and prev != name:
+            args += ["--link-dest", "%s/%s" % (_releases_path(), prev)]
+        elif not prev:
+            args += ["--delay-updates"]
+        work = None
+        if not path:
+            work = tempfile.mkdtemp()
+            check_call(["bash", "-o", "pipefail", "-c", "%s | tar -xf - -C %s" % (tar, work)])
+        try:
+            args += [(path or work).rstrip("/") + "/", "%s:%s/" % (target, dest)]
+            util.print_command(" ".join(args))
+            check_call(args, env=ssh_env)
+        finally:
+            if work:
+                shutil.rmtree(work)
+
+    if _use_releases():
+        _switch_release(name)
+        _prune_releases(name)
+    env.user = u
 
 
 @task
+@util.print_header
 def install():
     """
     Create the python virtualenv and deployment directories if necessary
@@ -178,6 +272,7 @@ def install():
     return False
 
 
+@task
 def set_permissions():
     """
     Ensure that the project entire virtualenv is owned by the project user,
@@ -185,36 +280,396 @@ def set_permissions():
 
     This allows the privileged fabric ssh user to modify these files during
     deployment, but keeps everything nicely isolated when accessed from inside
-    the running application.
+    the running application. This walks the entire virtualenv, so deployments only
+    fix up the files they change (see set_changed_permissions); run this task to
+    repair the whole tree.
     """
 
     system.sudo("chown -R %s:%s %s" % (env.project_user, env.project_group, env.virtualenv_path))
-    system.sudo("find %s -type d -exec chmod 2775 {} \\;" % env.virtualenv_path)
-    system.sudo("find %s -type f -exec chmod g+rw {} \\;" % env.virtualenv_path)
+    system.sudo("find %s -type d -exec chmod 2775 {} + -o -type f -exec chmod g+rw {} +" %
+                env.virtualenv_path)
+
+
+def set_changed_permissions(old, new="HEAD", root=None, git_dir=None):
+    """
+    Apply the set_permissions() policy to only those paths in the project root that differ
+    between the old and new git revisions, plus any untracked files (eg. new submodules).
+
+    Paths are batched through xargs, so this costs a handful of processes regardless of how
+    many files changed; directories (including submodules) are fixed recursively. To fix up a
+    release directory rather than the project root, specify it as root, along with the
+    git_dir of the repository its revisions live in.
+    """
+    owner = "%s:%s" % (env.project_user, env.project_group)
+    if git_dir:
+        changed = "git --git-dir=%s diff -z --name-only --diff-filter=ACMRT %s %s" % (
+            git_dir, old, new)
+    else:
+        changed = ("{ git diff -z --name-only --diff-filter=ACMRT %s %s; "
+                   "git ls-files -z --others --exclude-standard; }" % (old, new))
+    system.sudo("\n".join([
+        "cd %s && l=$(mktemp) || exit 1" % (root or env.project_root),
+        "%s | sort -zu > $l" % changed,
+
+        # the changed paths themselves, recursively in the case of submodules
+        "xargs -0 -r sh -c 'chown -R %s \"$@\" && find \"$@\" -type d -exec chmod 2775 {} + "
+        "-o -type f -exec chmod g+rw {} +' sh < $l" % owner,
+
+        # and every directory above them, which may have been created by the push
+        "tr '\\0' '\\n' < $l | awk -F/ '{p=\"\"; for (i = 1; i < NF; i++) "
+        "{p = p (i > 1 ? \"/\" : \"\") $i; print p}}' | sort -u | tr '\\n' '\\0' "
+        "| xargs -0 -r sh -c 'chown %s \"$@\" && chmod 2775 \"$@\"' sh" % owner,
+        "rm -f $l",
+    ]))
+
+
+def _use_releases():
+    return bool(getattr(env, 'use_releases', False))
+
+
+def _releases_path():
+    return env.virtualenv_path + "/releases"
+
+
+def _release_repo():
+    return env.virtualenv_path + "/repo.git"
+
+
+def _current_release():
+    """
+    Return the name of the release the project root currently points to, or None.
+    """
+    with hide("output"):
+        out = system.run("r=$(readlink %s) && basename $r || true" % env.project_root,
+                         show=False)
+    return out.strip() or None
+
+
+def _push_release(rev):
+    """
+    Push to the bare release repository, then build and activate a release of the pushed commit.
+    """
+    sha = check_output(["git", "rev-parse", "HEAD^{commit}"]).strip()
+
+    u = env.user
+    env.user = env.ssh_user
+    with system.batch():
+        prev = system.run("r=$(readlink %s) && basename $r || true" % env.project_root)
+        system.run("mkdir -p %s" % _releases_path())
+        system.run("git init -q --bare --shared=group %s" % _release_repo())
+        share_objects()
+
+    h = _git_url(path=_release_repo())
+    util.print_command("git push %s HEAD:%s" % (h, rev))
+    check_call(["git", "push", h, "HEAD:refs/heads/%s" % rev], env=ssh.local_env())
+    with system.batch():
+        _publish_objects()
+
+    activate_release(sha, prev.stdout.strip() or None)
+    env.user = u
+
+
+def activate_release(sha, prev=None):
+    """
+    Build the release for the specified commit, if it does not already exist, and atomically
+    switch the project root to it; then prune all but the newest KEEP_RELEASES releases.
+
+    A new release starts as a hardlinked copy of the previous one, and git replaces only the
+    files that differ between the two commits. Git unlinks each file before writing it, so the
+    previous release is never modified, and unchanged files cost no space or copying.
+    Submodules are not checked out into releases.
+    """
+    releases = _releases_path()
+    new = "%s/%s" % (releases, sha)
+    built = exists(new)
+    fresh = not prev or not exists("%s/.%s.index" % (releases, prev))
+
+    with system.batch():
+        if not built:
+            system.sudo(_release_script(releases, _release_repo(), sha, None if fresh else prev))
+            if not fresh:
+                set_changed_permissions(prev, sha, root=new + ".tmp", git_dir=_release_repo())
+            system.sudo("mv -T %s.tmp %s" % (new, new))
+    if fresh and not built:
+        set_permissions()
+
+    _switch_release(sha)
+    _prune_releases(sha)
+
+
+def _release_script(releases, repo, sha, prev=None):
+    """
+    Return the commands that build releases/<sha>.tmp from the repository, starting from a
+    hardlinked copy of the prev release and its index, if specified.
+    """
+    new = "%s/%s" % (releases, sha)
+    git = "GIT_INDEX_FILE=%s/.%s.index git --git-dir=%s --work-tree=%s.tmp" % (
+        releases, sha, repo, new)
+    steps = ["set -e", "rm -rf %s.tmp" % new]
+    if not prev:
+        steps += ["mkdir -p %s.tmp" % new,
+                  "%s read-tree --reset -u %s" % (git, sha)]
+    else:
+        steps += ["cp -al %s/%s %s.tmp" % (releases, prev, new),
+                  "cp %s/.%s.index %s/.%s.index" % (releases, prev, releases, sha),
+
+                  # linking (and permission sweeps) change the ctime of every file, so the
+                  # copied index must be refreshed before git will trust the tree to be clean.
+                  "%s update-index -q --refresh || true" % git,
+                  "%s read-tree -m -u %s %s" % (git, prev, sha)]
+    return "\n".join(steps)
+
+
+def _prune_releases(current):
+    """
+    Remove all but the newest KEEP_RELEASES releases, never including the current one.
+    """
+    keep = int(getattr(env, 'keep_releases', None) or 5)
+    system.sudo(
+        "cd %s && ls -1t | grep -v -x -e '.*\\.tmp' -e %s | tail -n +%d "
+        "| while read r; do rm -rf \"$r\" \".$r.index\"; done" % (
+            _releases_path(), current, keep))
+
+
+def _switch_release(name):
+    """
+    Atomically point the project root at the named release, by renaming a new symlink over it.
+    """
+    root = env.project_root
+    system.sudo("\n".join([
+        "if [ -d %s ] && [ ! -L %s ]; then" % (root, root),
+        "  echo '%s is a directory; move it aside to switch to releases.'; exit 1" % root,
+        "fi",
+        "touch %s/%s" % (_releases_path(), name),
+        "ln -sfn %s/%s %s.cotton-new && mv -T %s.cotton-new %s" % (
+            _releases_path(), name, root, root, root),
+    ]))
+
+
+@task
+@util.print_header
+def rollback(release=None):
+    """
+    Switch the project root back to an earlier release, with USE_RELEASES
+
+    Without a release (a commit sha, or a unique prefix of one), switches to the most recently
+    active release other than the current one.
+    """
+    current = _current_release()
+    with hide("output"):
+        available = system.run("cd %s && ls -1t | grep -v -x '.*\\.tmp' || true" %
+                               _releases_path(), show=False).split()
+    candidates = [r for r in available if r != current and r.startswith(release or "")]
+    if not candidates or (release and len(candidates) > 1):
+        abort("No unique release to roll back to; available: %s" % ", ".join(available))
+    print "Rolling back from %s to %s" % (current, candidates[0])
+    _switch_release(candidates[0])
+
+
+def _project_repo():
+    """
+    Return the path of the project's git directory on the remote host.
+    """
+    return _release_repo() if _use_releases() else env.project_root + "/.git"
+
+
+def _store_remote():
+    return re.sub(r'[^\w.-]', '_', env.project_name)
+
+
+def share_objects():
+    """
+    If GIT_SHARED_OBJECTS is set, make the project repository borrow objects from the host's
+    shared object store (through objects/info/alternates), creating the store if necessary.
+
+    Every project repository on the host is registered as a remote of the store, whose refs
+    (under refs/projects/<project>/) receive-pack advertises to us, so pushes need only send the
+    objects that are new to the host. Commands are queued if called inside system.batch().
+    """
+    store = getattr(env, 'git_shared_objects', None)
+    if not store:
+        return
+    util.sync_templates(env.git_gc_templates)
+
+    name = _store_remote()
+    system.sudo("[ -d %s ] || { mkdir -p %s && chown %s:staff %s; }" % (
+        store, store, env.ssh_user, store))
+    system.run("git init -q --bare --shared=group %s" % store)
+    system.run("git --git-dir=%s config remote.%s.url %s" % (store, name, _project_repo()))
+    system.run("git --git-dir=%s config --replace-all remote.%s.fetch "
+               "'+refs/heads/*:refs/projects/%s/*'" % (store, name, name))
+    system.run("echo %s/objects > %s/objects/info/alternates" % (store, _project_repo()))
+
+
+def _publish_objects():
+    """
+    Fetch the project's refs into the shared object store, so other projects can reuse them.
+    """
+    store = getattr(env, 'git_shared_objects', None)
+    if store:
+        system.run("git --git-dir=%s fetch -q --prune %s" % (store, _store_remote()))
+
+
+@task
+@util.print_header
+def gc():
+    """
+    Refresh, gc and repack the shared git object store and the project repositories using it
+
+    Objects the project repositories share with the store are dropped from their own packs.
+    This is also run on the schedule in GIT_GC_SCHEDULE.
+    """
+    if not getattr(env, 'git_shared_objects', None):
+        abort("GIT_SHARED_OBJECTS is not set.")
+    util.sync_templates(env.git_gc_templates)
+    u = env.user
+    env.user = env.ssh_user
+    system.run("/usr/local/sbin/cotton-git-gc")
+    env.user = u
+
+
+def _git_url(host_string=None, path=None):
+    """
+    Return the ssh URL of the project (or specified) repository on the current (or specified)
+    host.
+    """
+    (user, host, port) = normalize(host_string or env.host_string)
+    return "ssh://%s@%s:%s%s" % (env.user or user, host, port or 22, path or env.project_root)
+
+
+def _remote_head():
+    """
+    Return the commit currently checked out in the project root, or None.
+    """
+    if _use_releases():
+        return _current_release()
+    with cd(env.project_root):
+        with hide("output"):
+            head = system.run("git rev-parse --verify -q HEAD || true", show=False)
+    return head.strip() or None
 
 
-def define_local_git_ssh():
+def _relay(bundle, children):
     """
-    Configure git to execute ssh with the corrrect identity file.
+    Copy the bundle from the current host to each of the children, concurrently.
+    """
+    targets = []
+    for child in children:
+        (user, host, port) = normalize(child)
+        targets.append("scp -q -P %s %s %s@%s:%s &" % (
+            port or 22, bundle, env.user or user, host, bundle))
+    system.run(" ".join(targets + ["wait"]))
+
 
-    WAT: This is likely deprecated now that we correctly honor fab's command-line overrides,
-    so we should consider this for removal.
+def _apply_bundle(bundle, old, sha):
+    """
+    Fetch the distributed revision from the bundle into GIT_BRANCH, and check it out.
+    """
+    if _use_releases():
+        with system.batch():
+            system.run("mkdir -p %s" % _releases_path())
+            system.run("git init -q --bare --shared=group %s" % _release_repo())
+            share_objects()
+            system.run("git --git-dir=%s fetch -q %s +refs/cotton/distribute:refs/heads/%s" % (
+                _release_repo(), bundle, env.git_branch))
+            _publish_objects()
+            system.run("rm -f %s" % bundle)
+        return activate_release(sha, old)
+
+    with cd(env.project_root):
+        with system.batch():
+            system.run("git init")
+            system.run("git config core.sharedRepository group")
+            share_objects()
+            system.run("git fetch -q --update-head-ok %s +refs/cotton/distribute:refs/heads/%s" % (
+                bundle, env.git_branch))
+            _publish_objects()
+            system.run("git checkout -f %s" % env.git_branch)
+            system.run("git reset --hard")
+            system.run("git submodule update --init")
+            system.run("rm -f %s" % bundle)
+            if old:
+                set_changed_permissions(old)
+        if not old:
+            set_permissions()
+
+
+@task
+@runs_once
+@util.print_header
+def distribute(rev=None, fanout=None):
     """
-    if not env.key_filename:
+    Ship a revision to every host once, then relay it host-to-host in a tree
+
+    The objects new to the fleet are packed into a single git bundle, uploaded to the first
+    host, and copied onwards by each host that has it to up to GIT_FANOUT more, so the
+    deploying machine's uplink carries them only once. Relaying requires that the hosts can ssh
+    to one another, typically with agent forwarding (fab -A), and know each other's host keys.
+    Hosts that already have the revision checked out are left alone.
+    """
+    if rev is None:
+        rev = env.git_branch
+    fanout = int(fanout or getattr(env, 'git_fanout', None) or 4)
+    hosts = list(env.hosts)
+    sha = check_output(["git", "rev-parse", rev + "^{commit}"]).strip()
+
+    # Find out what each host already has; if we have all of their revisions, the bundle need
+    # only contain what is new since their common ancestor.
+    outcomes = fleet.schedule(_remote_head, hosts, concurrency=fanout * 4)
+    _require_success(outcomes)
+    heads = dict([(o['host'], o['result']) for o in outcomes])
+    hosts = [h for h in hosts if heads[h] != sha]
+    if not hosts:
+        print "Every host is already at %s." % sha
         return
 
-    sh = './fabric_ssh.sh'
+    basis = []
+    known = [heads[h] for h in hosts if heads[h] and call(
+        ["git", "cat-file", "-e", heads[h] + "^{commit}"], stderr=open(os.devnull, 'w')) == 0]
+    if known and len(known) == len(hosts):
+        base = check_output(["git", "merge-base", "--octopus"] + known).strip()
+
+        # git refuses to create an empty bundle, as it would be if every host were ahead of sha.
+        if base != sha:
+            basis = ["^" + base]
+
+    local = "cotton-%s.bundle" % sha[:12]
+    bundle = "/tmp/" + local
+    check_call(["git", "update-ref", "refs/cotton/distribute", sha])
+    try:
+        check_call(["git", "bundle", "create", local, "refs/cotton/distribute"] + basis)
+    finally:
+        check_call(["git", "update-ref", "-d", "refs/cotton/distribute"])
+    try:
+        execute(put, local, bundle, hosts=hosts[:1])
+    finally:
+        os.remove(local)
 
-    # skip host IP checking, but only in staging.
-    ssh_opts = ""
-    if env.environment == 'staging':
-        ssh_opts = '-oCheckHostIP=no'
+    # each level of the tree at most multiplies the number of hosts with the bundle by fanout+1.
+    have = hosts[:1]
+    need = hosts[1:]
+    while need:
+        assignments = {}
+        for holder in have:
+            assignments[holder] = need[:fanout]
+            need = need[fanout:]
+        _require_success(fleet.schedule(
+            lambda: _relay(bundle, assignments[env.host_string]),
+            [h for h in have if assignments[h]], concurrency=len(have)))
+        have += sum(assignments.values(), [])
 
-    with open(sh, 'w') as f:
-        f.write('#!/bin/sh\n')
-        f.write('ssh -i %s %s $*' % (env.key_filename, ssh_opts))
-    os.chmod(sh, 0755)
-    os.environ.setdefault('GIT_SSH', sh)
+    _require_success(fleet.schedule(
+        lambda: _apply_bundle(bundle, heads.get(env.host_string), sha), hosts,
+        concurrency=fanout * 4))
+
+
+def _require_success(outcomes):
+    """
+    Abort unless every host in a fleet.schedule() run succeeded.
+    """
+    failed = [o['host'] for o in outcomes if o['status'] != 'ok']
+    if failed:
+        abort("Distribution failed on: %s" % ", ".join(failed))
 
 
 def get_git_remotes():
@@ -240,32 +695,17 @@ def create_user():
     it be a member of the staff group.
     """
 
-    # warnings only, since we accept more than the 0 exit status.
-    with settings(warn_only=True):
-        system.sudo("groupadd -f %s" % env.project_group)
-        result = system.sudo(
-            "useradd -g {1} -m -d /home/{0} -s /bin/bash {0}".format(
-                env.project_user,
-                env.project_group
-            )
-        )
-    if result.return_code not in [0, 9]:
-        print result
-        raise SystemExit()
-
-    system.run("mkdir -p /home/%s/.ssh" % env.project_user)
     key = "keys/%s.pub" % env.project_user
-    if (os.path.exists(key)):
-        put(key, "/home/%s/.ssh/authorized_keys" % env.project_user)
-        system.run("chmod 600 /home/%s/.ssh/authorized_keys" % env.project_user)
-    else:
+    if not os.path.exists(key):
         print "Warning: No public key found for user %s!" % env.project_user
-    system.run("chown -R {0}:{0} /home/{0}/.ssh".format(env.project_user))
-    system.run("chmod 700 /home/%s/.ssh" % env.project_user)
 
-    # We place the fabric ssh user in the project group, because the
-    # fabric user needs to be able to modify files owned by the user.
-    system.sudo("usermod -a -G {1} {0}".format(env.ssh_user, env.project_group))
+    return system.ensure_accounts([
+        {"name": env.project_user, "group": env.project_group, "key": key},
+
+        # We place the fabric ssh user in the project group, because the
+        # fabric user needs to be able to modify files owned by the user.
+        {"name": env.ssh_user, "groups": [env.project_group]},
+    ])
 
 
 @task
@@ -276,19 +716,359 @@ def pip(packages):
     return system.sudo("pip install %s" % packages)
 
 
+def _wheelhouse_key(files):
+    """
+    Return the cache key of the wheelhouse for the specified requirement files' contents.
+    """
+    return journal.digest(
+        [contents for (fn, contents) in files], getattr(env, 'wheelhouse_builder', None))[:16]
+
+
+def _build_remote_wheelhouse(files, key, local_path):
+    """
+    Build the wheelhouse on the current host, and download it as a tarball to local_path.
+    """
+    work = "/tmp/cotton-wheelhouse-%s" % key
+    system.run("rm -rf %s && mkdir -p %s/requirements" % (work, work))
+    requirements = []
+    for (i, (fn, contents)) in enumerate(files):
+        requirements.append("%s/requirements/%d.txt" % (work, i))
+        put(StringIO(contents + "\n"), requirements[-1])
+    system.run("pip wheel -q -w %s/wheels %s && tar -czf %s.tar.gz -C %s/wheels ." % (
+        work, " ".join(["-r " + r for r in requirements]), work, work))
+    get(work + ".tar.gz", local_path)
+    system.run("rm -rf %s %s.tar.gz" % (work, work))
+
+
+def _build_local_wheelhouse(files, local_path):
+    """
+    Build the wheelhouse locally, as a tarball at local_path.
+    """
+    work = tempfile.mkdtemp()
+    try:
+        args = ["pip", "wheel", "-q", "-w", work + "/wheels"]
+        for (i, (fn, contents)) in enumerate(files):
+            with open("%s/%d.txt" % (work, i), "w") as f:
+                f.write(contents + "\n")
+            args += ["-r", "%s/%d.txt" % (work, i)]
+        util.print_command(" ".join(args))
+        check_call(args)
+        check_call(["tar", "-czf", local_path, "-C", work + "/wheels", "."])
+    finally:
+        shutil.rmtree(work)
+
+
 @task
+def build_wheelhouse(files=None):
+    """
+    Build wheels for the python requirements, once, and return the local path of their tarball
+
+    The requirements are those in the PIP_REQUIREMENTS_PATH files on the current host (or the
+    (path, contents) tuples in files), as returned by read_requirements(). Wheels are built on
+    WHEELHOUSE_BUILDER, which should match the platform of the deployment hosts, or locally if
+    it is not set. Tarballs are cached under COTTON_CACHE_PATH by the digest of the requirements,
+    and built under a lock, so each set of requirements is only ever built once, even by the
+    concurrent workers of a fleet rollout.
+    """
+    if files is None:
+        files = read_requirements()[1]
+
+    cache = os.path.join(
+        os.path.expanduser(getattr(env, 'cotton_cache_path', None) or '~/.cotton'), 'wheelhouse')
+    key = _wheelhouse_key(files)
+    archive = os.path.join(cache, key + ".tar.gz")
+    if os.path.exists(archive):
+        return archive
+    if not os.path.isdir(cache):
+        try:
+            os.makedirs(cache)
+        except OSError:
+            if not os.path.isdir(cache):
+                raise
+
+    with open(archive + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # whoever held the lock before us may have built it while we waited.
+        if os.path.exists(archive):
+            return archive
+
+        # build to a temporary name, so that an interrupted build is never mistaken for a
+        # cached one.
+        tmp = "%s.%s" % (archive, os.getpid())
+        builder = getattr(env, 'wheelhouse_builder', None)
+        if builder:
+            execute(_build_remote_wheelhouse, files, key, tmp, hosts=[builder])
+        else:
+            _build_local_wheelhouse(files, tmp)
+        os.rename(tmp, archive)
+    return archive
+
+
+def ship_wheelhouse(archive):
+    """
+    Upload and unpack a wheelhouse tarball on the current host, unless it is already there, and
+    return its remote path. Any other wheelhouses on the host are removed.
+    """
+    key = os.path.basename(archive).split(".")[0]
+    root = env.virtualenv_path + "/wheelhouse"
+    remote = "%s/%s" % (root, key)
+    if not exists(remote):
+        system.sudo("mkdir -p %s" % root)
+        put(archive, remote + ".tar.gz", use_sudo=True)
+        system.sudo("mkdir -p %s && tar -xzf %s.tar.gz -C %s && rm -f %s.tar.gz" % (
+            remote, remote, remote, remote))
+    system.sudo("find %s -mindepth 1 -maxdepth 1 ! -name %s -exec rm -rf {} +" % (root, key))
+    return remote
+
+
+def _applied_path():
+    return env.virtualenv_path + "/.cotton-requirements"
+
+
+# lists the dependencies between the virtualenv's installed packages, one per line.
+REQUIRES = "python -c %s" % quote("\n".join([
+    "import pkg_resources",
+    "for d in pkg_resources.working_set:",
+    "    try:",
+    "        for r in d.requires():",
+    "            print('__cotton_requires ' + d.key + ' ' + r.key)",
+    "    except Exception:",
+    "        pass",
+]))
+
+
+def read_requirements():
+    """
+    Read the state of the virtualenv's python requirements, in a single command.
+
+    Returns a tuple of the installed packages (as {key: version}, from pip freeze), the contents
+    of the PIP_REQUIREMENTS_PATH files present on the remote host (as a list of (path, contents)
+    tuples), the contents of the requirements that were last applied to the virtualenv, and the
+    installed packages that depend upon each installed package (as {key: set of keys}).
+    """
+    paths = [env.project_root + '/' + p for p in getattr(env, 'pip_requirements_path', [])]
+    with project(env):
+        with hide("output"):
+            out = system.run(_requirements_script(paths, _applied_path()), show=False)
+    return _parse_requirements_state(out)
+
+
+def _requirements_script(paths, applied, freeze="pip freeze", requires=REQUIRES):
+    """
+    Return the command that reports the installed packages and their dependencies, the last
+    applied requirements and the requirements files in paths. Every section is followed by a
+    newline of its own, so that files without a trailing newline cannot run into the marker
+    that follows them.
+    """
+    script = ["%s 2>/dev/null" % freeze, "%s 2>/dev/null" % requires, "echo __cotton_applied",
+              "cat %s 2>/dev/null; echo" % applied]
+    for fn in paths:
+        script.append("[ ! -f %s ] || { echo '__cotton_file %s'; cat %s; echo; }" % (fn, fn, fn))
+    return " ; ".join(script)
+
+
+def _parse_requirements_state(out):
+    """
+    Parse the output of the _requirements_script() command; see read_requirements().
+    """
+    installed = {}
+    required = {}
+    applied = []
+    files = []
+    section = None
+    for line in out.splitlines():
+        if section is None and line.startswith("__cotton_requires "):
+            (dist, req) = line.split()[1:3]
+            required.setdefault(req, set()).add(dist)
+        elif line == "__cotton_applied":
+            section = applied
+        elif line.startswith("__cotton_file "):
+            files.append((line.split(" ", 1)[1], []))
+            section = files[-1][1]
+        elif section is not None:
+            section.append(line)
+        elif "==" in line and not line.startswith("-"):
+            (name, version) = line.split("==", 1)
+            installed[pkg_resources.safe_name(name).lower()] = version.strip()
+
+    # trailing blank lines are an artifact of the separating newlines, not of the contents.
+    join = lambda lines: "\n".join(lines).rstrip("\n")
+    return (installed, [(fn, join(lines)) for (fn, lines) in files], join(applied), required)
+
+
+def _parse_requirements(text):
+    """
+    Parse the contents of requirements files into a dict of {key: Requirement}, and a list of
+    any lines (includes, options, editables, URLs...) that are not simple requirements.
+    """
+    requirements = {}
+    other = []
+    for line in text.splitlines():
+        line = line.split(" #")[0].strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            req = pkg_resources.Requirement.parse(line)
+            requirements[req.key] = req
+        except ValueError:
+            other.append(line)
+    return (requirements, other)
+
+
+def _requirements_delta(installed, current, applied, required=None):
+    """
+    Compare the current requirements with those last applied and the installed packages, and
+    return a tuple of the requirements to install and the package keys to uninstall. Packages
+    that another installed package still depends upon (see read_requirements) are not
+    uninstalled, even if they were removed from the requirements.
+    """
+    (wanted, other) = _parse_requirements(current)
+    (previous, previous_other) = _parse_requirements(applied)
+    changed = [
+        str(req) for (key, req) in sorted(wanted.items())
+        if key not in installed or installed[key] not in req or previous.get(key) != req
+    ]
+    removed = [key for key in sorted(previous) if key not in wanted and key in installed]
+
+    # keeping one package may mean keeping the packages it depends upon, in turn.
+    required = required or {}
+    while True:
+        kept = [key for key in removed if [
+            d for d in required.get(key, []) if d in installed and d not in removed]]
+        if not kept:
+            return (changed, removed)
+        removed = [key for key in removed if key not in kept]
+
+
+@task
+@util.print_header
 def install_dependencies():
     """
     Install any missing or updated python modules listed in PIP_REQUIREMENTS_PATH
+
+    Only the requirements that were added or changed since they were last applied, or that the
+    installed packages do not satisfy, are passed to pip; requirements that were removed are
+    uninstalled, unless another installed package depends upon them. If the requirements files have not changed at all, pip is not run (unless
+    FORCE is set). Files containing anything other than simple requirements are installed in
+    full whenever those lines change.
+
+    With PIP_WHEELHOUSE, the requirements are built into wheels once (see build_wheelhouse),
+    shipped to the host as a single tarball, and installed without consulting the package index.
     """
 
+    (installed, files, applied, required) = read_requirements()
+    current = "\n".join([contents for (fn, contents) in files])
+    if current == applied and not journal.forced():
+        print "Python requirements are unchanged since they were last applied; skipping."
+        cache_virtualenv(current)
+        return
+
+    (changed, removed) = _requirements_delta(installed, current, applied, required)
+    other = _parse_requirements(current)[1]
+    previous_other = _parse_requirements(applied)[1]
+
+    options = ""
+    if getattr(env, 'pip_wheelhouse', False):
+        options = "--no-index --find-links=%s " % ship_wheelhouse(build_wheelhouse(files))
+
     with project(env):
-        for p in getattr(env, 'pip_requirements_path', []):
-
-            # skip any requirements file that doesn't exist on the remote host. This lets us
-            # ignore cotton's default requirements, if they're listed in the env.
-            #
-            # WAT Should we print a warning here? meh.
-            fn = env.project_root + '/' + p
-            if exists(fn):
-                pip("-r %s" % fn)
+        if removed:
+            system.sudo("pip uninstall -y %s" % " ".join(removed))
+
+        if journal.forced():
+            for (fn, contents) in files:
+                pip("%s-r %s" % (options, fn))
+        else:
+            # lines we can't reason about mean pip must resolve the files in which they appear.
+            if sorted(other) != sorted(previous_other):
+                for (fn, contents) in files:
+                    if _parse_requirements(contents)[1]:
+                        pip("%s-r %s" % (options, fn))
+            if changed:
+                pip(options + " ".join([quote(r) for r in changed]))
+
+    put(StringIO(current + "\n"), _applied_path(), use_sudo=True)
+    cache_virtualenv(current)
+
+
+def _virtualenv_key(requirements):
+    """
+    Return the cache key for virtualenvs built with the host's python and the requirements, as
+    the contents of the requirements files (see install_dependencies).
+    """
+    with hide("output"):
+        version = system.run("python -c 'import sys; print(sys.version)'; virtualenv --version",
+                             show=False)
+    return journal.digest(version.strip(), requirements)[:16]
+
+
+def _pending_requirements():
+    """
+    Return the contents of the requirements that a new virtualenv will be built with: those of
+    the PIP_REQUIREMENTS_PATH files on the host if the project is already there, or else those
+    of the files in the local working copy that is about to be pushed.
+    """
+    paths = getattr(env, 'pip_requirements_path', [])
+    with hide("output"):
+        out = system.run(_requirements_script(
+            [env.project_root + '/' + p for p in paths], _applied_path(), freeze="true",
+            requires="true"),
+            show=False)
+    files = _parse_requirements_state(out)[1]
+    if not files and env.use_git:
+        root = check_output(["git", "rev-parse", "--show-toplevel"]).strip()
+        for p in paths:
+            if os.path.isfile(root + '/' + p):
+                with open(root + '/' + p) as f:
+                    files.append((p, f.read().rstrip("\n")))
+    return "\n".join([contents for (fn, contents) in files])
+
+
+def clone_virtualenv(requirements):
+    """
+    Create VIRTUALENV_PATH as a clone of a cached virtualenv built with the same python and
+    requirements, if VIRTUALENV_CACHE is set and there is one; returns True if so.
+
+    Files are copied with reflinks where the filesystem supports them, or hardlinked if
+    VIRTUALENV_CACHE_LINK is set, and the cached virtualenv's path is then replaced with ours
+    in its scripts and .pth files.
+    """
+    if not getattr(env, 'virtualenv_cache', None):
+        return False
+    cached = "%s/%s" % (env.virtualenv_cache, _virtualenv_key(requirements))
+    if not exists(cached):
+        return False
+
+    venv = env.virtualenv_path
+    copy = "cp -al" if getattr(env, 'virtualenv_cache_link', False) else "cp -a --reflink=auto"
+    system.sudo("\n".join([
+        "set -e",
+        "origin=$(cat %s/.cotton-origin)" % cached,
+        "mkdir -p %s && %s %s/. %s && rm -f %s/.cotton-origin" % (venv, copy, cached, venv, venv),
+        "cd %s && grep -rlIF \"$origin\" bin lib/*/site-packages/*.pth "
+        "lib/*/site-packages/*.egg-link 2>/dev/null | xargs -r sed -i \"s#$origin#%s#g\"" % (
+            venv, venv),
+    ]))
+    return True
+
+
+def cache_virtualenv(requirements):
+    """
+    Copy the virtualenv, without the project, into VIRTUALENV_CACHE (if it is set) for later use
+    by clone_virtualenv(), unless there is already an entry for its python and requirements.
+    """
+    if not getattr(env, 'virtualenv_cache', None):
+        return
+    cached = "%s/%s" % (env.virtualenv_cache, _virtualenv_key(requirements))
+    if exists(cached):
+        return
+
+    system.sudo("\n".join([
+        "set -e",
+        "rm -rf %s.tmp && mkdir -p %s.tmp" % (cached, cached),
+        "cd %s && for f in bin include lib lib64 local pyvenv.cfg .cotton-requirements; do "
+        "[ ! -e $f ] || cp -a --reflink=auto $f %s.tmp/; done" % (env.virtualenv_path, cached),
+        "echo %s > %s.tmp/.cotton-origin" % (env.virtualenv_path, cached),
+        "mv -T %s.tmp %s" % (cached, cached),
+    ]))
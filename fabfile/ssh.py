@@ -0,0 +1,96 @@
+"""
+Persistent, multiplexed OpenSSH control connections for local subprocesses.
+
+Fabric talks to the remote hosts over its own paramiko session, but local tools (git, scp, rsync)
+spawn OpenSSH, which would otherwise perform a full key exchange on every invocation. Instead,
+cotton keeps one OpenSSH control master per host (see ControlMaster in ssh_config(5)), and points
+GIT_SSH at a wrapper script that reuses it.
+"""
+import os
+import stat
+import subprocess
+from fabric.api import env
+
+
+def _root():
+    root = os.path.expanduser(getattr(env, 'cotton_cache_path', None) or '~/.cotton')
+    path = os.path.join(root, 'ssh')
+    if not os.path.isdir(path):
+        os.makedirs(path, 0700)
+    return path
+
+
+def options():
+    """
+    Return the ssh command-line options that enable connection sharing.
+    """
+    opts = [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=%s' % os.path.join(_root(), '%r@%h:%p'),
+        '-o', 'ControlPersist=%s' % (getattr(env, 'ssh_control_persist', None) or '10m'),
+    ]
+
+    keys = env.key_filename or []
+    for key in [keys] if isinstance(keys, basestring) else keys:
+        opts += ['-i', os.path.expanduser(key)]
+
+    # skip host IP checking, but only in staging.
+    if getattr(env, 'environment', None) == 'staging':
+        opts += ['-o', 'CheckHostIP=no']
+    return opts
+
+
+def _target():
+    return ['-p', str(env.port or 22), '%s@%s' % (env.user, env.host)]
+
+
+def master():
+    """
+    Ensure a control master is running for the current host, starting one if necessary.
+    """
+    with open(os.devnull, 'w') as devnull:
+        running = subprocess.call(
+            ['ssh'] + options() + ['-O', 'check'] + _target(), stdout=devnull, stderr=devnull)
+        if running != 0:
+            subprocess.check_call(
+                ['ssh'] + options() + ['-o', 'ControlMaster=yes', '-f', '-N'] + _target(),
+                stdout=devnull)
+
+
+def wrapper():
+    """
+    Write a script suitable for GIT_SSH that runs ssh with connection sharing enabled, and
+    return its path.
+    """
+    path = os.path.join(_root(), 'cotton_ssh.sh')
+    script = '#!/bin/sh\nexec ssh %s "$@"\n' % ' '.join(["'%s'" % o for o in options()])
+    if not os.path.exists(path) or open(path).read() != script:
+
+        # write atomically, so a forked worker never runs a script another is still writing.
+        tmp = "%s.%s" % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(script)
+        os.chmod(tmp, stat.S_IRWXU)
+        os.rename(tmp, path)
+    return path
+
+
+def local_env():
+    """
+    Return an environment for local subprocesses (git, scp, rsync) talking to the current host,
+    starting the host's control master if it isn't already running.
+    """
+    master()
+    e = dict(os.environ)
+    e['GIT_SSH'] = wrapper()
+    e['RSYNC_RSH'] = e['GIT_SSH']
+    return e
+
+
+def close():
+    """
+    Shut down the control master for the current host, if any.
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(
+            ['ssh'] + options() + ['-O', 'exit'] + _target(), stdout=devnull, stderr=devnull)
@@ -1,11 +1,24 @@
-from fabric.api import env, task, settings, put, hide, run as frun, sudo as fsudo
+from fabric.api import env, task, settings, hide, abort
 from fabric.contrib.files import exists
-from .. import util
+from contextlib import contextmanager
+from .. import util, facts, graph, journal
+from ..instrument import put, run as frun, sudo as fsudo
+from pipes import quote
+import threading
+import hashlib
+import json
 import re
 import os
 
+# the queue of commands for the current batch(), if any
+_batch = threading.local()
+
+# the output of each command in a batch script, between its markers
+BATCH_OUTPUT = re.compile(r"^__cotton_begin_(\d+)\n(.*?)\n__cotton_end_\1 (\d+)$", re.M | re.S)
+
 
 @task
+@util.print_header
 def create_staff():
     """
     Create any missing staff accounts.
@@ -15,37 +28,152 @@ def create_staff():
     via (at least) key exchange.
     """
 
-    for u in env.staff_users:
-        with settings(warn_only=True):
-
-            # create the user in their own primary group, and add them to both
-            # sudo and staff
-            result = sudo(
-                "useradd -U -G sudo,staff -m -d /home/%s -s /bin/bash %s" % (u, u))
-
-            # user either was created, or already exists
-            if result.return_code in [0, 9]:
-
-                # If the local directory contains a keys subdirectory, and the keys dir
-                # contains a public key with the same name as this user, automatically deploy
-                # the key into the remote user's authorized_keys list.
-                #
-                # WAT: We should probably allow for key generation here
-                # WAT WAT: We should make SSH access disabled by default, and
-                # configurable.
-                run("mkdir -p /home/%s/.ssh" % u)
-                key = "keys/%s.pub" % u
-                if (os.path.exists(key)):
-                    put(key, "/home/%s/.ssh/authorized_keys" % u)
-                    run("chmod 600 /home/%s/.ssh/authorized_keys" % u)
-                run("chown -R %s:%s /home/%s/.ssh" % (u, u, u))
-                run("chmod 700 /home/%s/.ssh" % u)
-            else:
-                print result
-                raise SystemExit()
+    # create the users in their own primary group, and add them to both sudo and staff.
+    #
+    # If the local directory contains a keys subdirectory, and the keys dir
+    # contains a public key with the same name as this user, automatically deploy
+    # the key into the remote user's authorized_keys list.
+    #
+    # WAT: We should probably allow for key generation here
+    # WAT WAT: We should make SSH access disabled by default, and
+    # configurable.
+    return ensure_accounts([
+        {"name": u, "groups": ["sudo", "staff"], "key": "keys/%s.pub" % u}
+        for u in env.staff_users
+    ])
+
+
+def _account_state(names, groups):
+    """
+    Read the passwd and group entries and the authorized_keys state of the specified users
+    and groups, in a single remote command.
+
+    Returns (users, groups), where users is {name: {'gid', 'home', 'key', 'ssh'}} for each
+    user that exists, and groups is {name: {'gid', 'members'}} for each group that exists.
+    """
+    q = lambda items: " ".join([quote(i) for i in items])
+    cmd = "\n".join([
+        "for u in %s; do" % q(names),
+        '  getent passwd "$u" | sed "s/^/passwd /"',
+        '  d=/home/$u/.ssh',
+        '  [ -d $d ] && echo "sshdir $u $(stat -c \'%U:%G %a\' $d)"',
+        '  [ -f $d/authorized_keys ] && echo "key $u $(sha256sum < $d/authorized_keys | '
+        'cut -d\' \' -f1) $(stat -c \'%U %a\' $d/authorized_keys)"',
+        "done",
+        "getent group %s | sed 's/^/group /'" % q(groups),
+        "true",
+    ])
+    with hide("output"):
+        out = sudo(cmd, show=False)
+
+    users = {}
+    existing_groups = {}
+    for line in out.splitlines():
+        (kind, _, rest) = line.strip().partition(" ")
+        if kind == "passwd":
+            fields = rest.split(":")
+            users[fields[0]] = {"gid": fields[3], "home": fields[5], "key": None, "ssh": None}
+        elif kind == "group":
+            fields = rest.split(":")
+            existing_groups[fields[0]] = {
+                "gid": fields[2], "members": [m for m in fields[3].split(",") if m]}
+        elif kind == "sshdir" and rest.split()[0] in users:
+            users[rest.split()[0]]["ssh"] = " ".join(rest.split()[1:])
+        elif kind == "key" and rest.split()[0] in users:
+            users[rest.split()[0]]["key"] = rest.split()[1:]
+    return (users, existing_groups)
+
+
+def ensure_accounts(accounts):
+    """
+    Create or update user accounts and their SSH keys, changing only what differs.
+
+    accounts is a list of dicts, with the keys:
+        name    the user name
+        group   the primary group; if None, the user gets a group of their own
+        groups  supplementary groups the user must belong to
+        key     the local path of a public key to install as the user's authorized_keys.
+                If the key is omitted or the file does not exist, keys are left alone.
+
+    The current state is read in one round trip; the changes, including all key uploads, are
+    then applied with a single transfer and a single batched command. Returns the list of
+    changes made.
+    """
+    names = [a["name"] for a in accounts]
+    wanted_groups = []
+    for a in accounts:
+        for g in ([a["group"]] if a.get("group") else []) + list(a.get("groups", [])):
+            if g not in wanted_groups:
+                wanted_groups.append(g)
+
+    (users, groups) = _account_state(names, wanted_groups)
+
+    changes = []
+    ssh_changes = []
+    files = []
+    for a in accounts:
+        u = a["name"]
+        primary = a.get("group")
+        if primary and primary not in groups:
+            changes.append("groupadd -f %s" % primary)
+            groups[primary] = {"gid": None, "members": []}
+
+        supplementary = list(a.get("groups", []))
+        if u not in users:
+            changes.append("useradd %s%s -m -d /home/%s -s /bin/bash %s" % (
+                "-g %s" % primary if primary else "-U",
+                " -G %s" % ",".join(supplementary) if supplementary else "",
+                u, u))
+            users[u] = {"gid": None, "home": "/home/%s" % u, "key": None, "ssh": None}
+        else:
+            missing = [
+                g for g in supplementary
+                if g in groups and u not in groups[g]["members"]
+                and groups[g]["gid"] != users[u]["gid"]
+            ]
+            if missing:
+                changes.append("usermod -a -G %s %s" % (",".join(missing), u))
+
+        key = a.get("key")
+        if not key or not os.path.exists(key):
+            continue
+
+        with open(key, "r") as f:
+            data = f.read()
+        owner = "%s:%s" % (u, primary or u)
+        ssh_dir = "/home/%s/.ssh" % u
+        upload = users[u]["key"] != [hashlib.sha256(data).hexdigest(), u, "600"]
+        if upload:
+            files.append({"remote_path": ssh_dir + "/authorized_keys", "data": data,
+                          "mode": "0600"})
+        if upload or users[u]["ssh"] != "%s 700" % owner:
+            ssh_changes.append("mkdir -p {0} && chown -R {1} {0} && chmod 700 {0}".format(
+                ssh_dir, owner))
+
+    if not changes and not ssh_changes:
+        print "All %d accounts are up to date." % len(accounts)
+        return []
+
+    # upload every key in one tarball; it is unpacked only once the accounts exist, so that
+    # useradd still creates the home directories from /etc/skel.
+    if files:
+        with hide("running", "stdout"):
+            tmp = frun("mktemp /tmp/cotton_keys.XXXXXXXXXX").strip()
+        put(util.pack_files(files), tmp)
+
+    with batch():
+        for c in changes:
+            sudo(c)
+        if files:
+            sudo("tar -x --no-same-owner -p -f %s -C / && rm -f %s" % (tmp, tmp))
+        for c in ssh_changes:
+            sudo(c)
+
+    return changes + ssh_changes
 
 
 @task
+@util.print_header
 def set_timezone(zone=None):
     """
     Set the system timezone
@@ -60,6 +188,7 @@ def set_timezone(zone=None):
 
 
 @task
+@util.print_header
 def set_locale(locale=None):
     """
     Set the system locale
@@ -78,22 +207,82 @@ def set_locale(locale=None):
 
 
 @task
+@util.print_header
 def ensure_running(service=None):
     """
     Ensure all services listed in settings.ENSURE_RUNNING are running
+
+    Each member of ENSURE_RUNNING is either the name of a sysvinit script, or a dict with the
+    key 'name' and optionally one readiness probe: 'port' (a local TCP port that must accept
+    connections), 'pidfile' (which must name a live process) or 'command' (which must exit 0),
+    plus a 'timeout' in seconds for the probe (default 30).
+
+    The status of every service is checked in a single remote command; only stopped services
+    are started, all at once, and each is then probed until it is ready.
     """
 
     if not service:
         svcs = env.ensure_running
     else:
         svcs = [service]
+    svcs = [s if isinstance(s, dict) else {"name": s} for s in svcs]
 
+    lines = []
     for svc in svcs:
-        util.print_command("Starting %s" % svc)
-        fsudo("/etc/init.d/{0} start".format(svc), pty=False)
+        name = quote(svc["name"])
+        if svc.get("port"):
+            probe = "(echo > /dev/tcp/127.0.0.1/%d) 2>/dev/null" % int(svc["port"])
+        elif svc.get("pidfile"):
+            probe = '[ -f {0} ] && kill -0 "$(cat {0})" 2>/dev/null'.format(quote(svc["pidfile"]))
+        else:
+            probe = svc.get("command")
+
+        lines += [
+            "if /etc/init.d/%s status >/dev/null 2>&1; then echo \"running %s\"; else (" % (
+                name, name),
+            "  t0=$(date +%s.%N)",
+            "  /etc/init.d/%s start >/dev/null 2>&1; rc=$?; t1=$(date +%%s.%%N); ready=-" % name,
+        ]
+        if probe:
+            lines += [
+                "  if [ $rc -eq 0 ]; then",
+                "    deadline=$(( $(date +%%s) + %d )); ready=ok" % int(svc.get("timeout", 30)),
+                "    until %s; do" % probe,
+                "      [ $(date +%s) -ge $deadline ] && { ready=timeout; break; }; sleep 0.5",
+                "    done",
+                "  fi",
+            ]
+        lines += [
+            "  echo \"started %s $rc $t0 $t1 $(date +%%s.%%N) $ready\"" % name,
+            ") & fi",
+        ]
+    lines.append("wait")
+
+    util.print_command("Starting %s" % ", ".join([svc["name"] for svc in svcs]))
+    with hide("running", "output"):
+        out = (frun if env.user == "root" else fsudo)("\n".join(lines), pty=False, label="init.d")
+
+    failed = []
+    print "%-20s %-10s %9s %9s" % ("service", "status", "start", "ready")
+    for line in out.splitlines():
+        parts = line.split()
+        if parts[:1] == ["running"]:
+            print "%-20s %-10s" % (parts[1], "running")
+        elif parts[:1] == ["started"] and len(parts) == 7:
+            (name, rc, t0, t1, t2, ready) = parts[1:]
+            status = "started" if rc == "0" and ready != "timeout" else "failed"
+            if status == "failed":
+                failed.append(name)
+            print "%-20s %-10s %8.2fs %9s" % (
+                name, status, float(t1) - float(t0),
+                "%.2fs" % (float(t2) - float(t0)) if ready == "ok" else ready)
+
+    if failed:
+        raise Exception("Could not start: %s" % ", ".join(failed))
 
 
 @task
+@util.print_header
 def bootstrap():
     """
     Meta-task that bootstraps the base system; must be run as root
@@ -109,39 +298,250 @@ def bootstrap():
     if env.user != "root":
         raise Exception("You must set SSH_USER=root to run bootstrap().")
 
-    set_timezone()
-    set_locale()
+    # The bootstrap steps, and the steps each depends upon; independent steps run concurrently.
+    # Note that create_staff only needs the sudo and staff groups, which exist on a stock system.
+    steps = [
+        {"name": "set_timezone", "func": set_timezone},
+        {"name": "set_locale", "func": set_locale},
+        {"name": "apt_proxy", "func": lambda: getattr(env, 'apt_proxy_host', None) and apt_proxy()},
+        {"name": "apt_update", "func": apt_update, "requires": ["apt_proxy"]},
+        {"name": "dist_upgrade", "func": dist_upgrade, "requires": ["apt_update"]},
+        {"name": "install_dependencies", "func": install_dependencies,
+         "requires": ["dist_upgrade"]},
+        {"name": "firewall", "func": firewall, "requires": ["install_dependencies"]},
+        {"name": "templates", "func": util.upload_all_templates,
+         "requires": ["install_dependencies"]},
+        {"name": "create_staff", "func": create_staff},
+        {"name": "ensure_running", "func": ensure_running,
+         "requires": ["install_dependencies", "templates"]},
+    ]
+    graph.execute(steps, getattr(env, 'bootstrap_concurrency', None) or 4)
 
-    sudo("apt-get update -y -q")
-    sudo("apt-get dist-upgrade -y -q")
 
-    install_dependencies()
-    firewall()
-    util.upload_all_templates()
-    create_staff()
-    ensure_running()
+@task
+def dist_upgrade():
+    """
+    Upgrade all installed packages, if any upgrades are pending
+    """
+    with hide("output"):
+        pending = sudo("apt-get -s -q dist-upgrade | grep -c '^Inst' || true", show=False)
+    if int(pending.strip() or 0):
+        sudo("apt-get dist-upgrade -y -q")
+        facts.forget()
 
 
 @task
+@util.print_header
+@journal.converges("apt", lambda: parse_requirements(env.apt_requirements_path))
 def install_dependencies():
     """
     Install or update system dependencies listed in APT_REQUIREMENTS_PATH
     """
 
-    # resolve any lingering conflicts of config files from aborted runs
-    sudo("dpkg --configure -a --force-confdef --force-confold")
-
-    # step through each file listed in the APT_REQUIREMENTS_PATH, and append every
-    # package name found therein to a list of packages we will hand to apt()
-    # to install.
-    reqs = ''
-    for p in env.apt_requirements_path:
+    # compare the packages listed in each file in APT_REQUIREMENTS_PATH against those
+    # installed on the host, and hand only the missing or mismatched ones to apt().
+    desired = parse_requirements(env.apt_requirements_path)
+    installed = installed_packages()
+    needed = [
+        name + ("=" + version if version else "")
+        for (name, version) in desired
+        if name not in installed or (version and installed[name] != version)
+    ]
+    if not needed:
+        print "All %d packages are up to date." % len(desired)
+        return None
+    return apt(" ".join(needed))
+
+
+def parse_requirements(paths):
+    """
+    Return a list of (package, version) tuples from the specified apt requirements files,
+    skipping blank lines and comments. Version is None unless pinned as package=version.
+    """
+    packages = []
+    for p in paths:
         fn = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), p))
-        print "Installing dependencies from %s" % fn
         with open(fn, 'r') as f:
-            for pkg in f.read().split('\n'):
-                reqs = "%s %s" % (reqs, pkg.strip())
-    return apt(reqs)
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    (name, _, version) = line.partition('=')
+                    packages.append((name.strip(), version.strip() or None))
+    return packages
+
+
+def installed_packages():
+    """
+    Return a dict of {package: version} for every package installed on the host, in a single
+    dpkg-query.
+
+    Any configuration left pending by an aborted dpkg run is resolved first, in the same command.
+    """
+    cmd = " ".join([
+        'if [ -n "$(ls -A /var/lib/dpkg/updates 2>/dev/null)" ]; then',
+        'dpkg --configure -a --force-confdef --force-confold >/dev/null;',
+        'fi;',
+        "dpkg-query -W -f='${Package}\\t${Version}\\t${Status}\\n'",
+    ])
+    with hide("output"):
+        out = sudo(cmd, show=False)
+
+    installed = {}
+    for line in out.splitlines():
+        parts = line.strip().split('\t')
+        if len(parts) == 3 and parts[2].endswith(' installed'):
+            installed[parts[0]] = parts[1]
+    return installed
+
+
+@task
+def apt_update(max_age=None):
+    """
+    Update the apt package lists, unless they are newer than APT_UPDATE_MAX_AGE seconds
+    """
+    if max_age is None:
+        max_age = getattr(env, 'apt_update_max_age', 0)
+
+    stamp = "/var/lib/apt/periodic/cotton-update-success-stamp"
+    cmd = " ".join([
+        't=$(stat -c %%Y %s /var/lib/apt/periodic/update-success-stamp 2>/dev/null' % stamp,
+        '| sort -n | tail -1);',
+        'if [ $(( $(date +%%s) - ${t:-0} )) -lt %d ]; then echo fresh;' % int(max_age),
+        'else apt-get update -y -q && mkdir -p %s && touch %s && echo updated; fi' % (
+            os.path.dirname(stamp), stamp),
+    ])
+    return sudo(cmd).strip().endswith("updated")
+
+
+@task
+@util.print_header
+def apt_proxy(host=None):
+    """
+    Serve (on APT_PROXY_HOST) or use (everywhere else) the fleet's apt package cache
+
+    The proxy host's APT_PROXY_FIREWALL rules are applied by firewall(), with the rest.
+    """
+    if host:
+        env.apt_proxy_host = host
+    if not getattr(env, 'apt_proxy_host', None):
+        raise Exception("You must set APT_PROXY_HOST to use an apt proxy.")
+
+    if env.apt_proxy_host in (env.host, env.host_string):
+
+        # the proxy host itself fetches from upstream, so must not point at the cache yet.
+        apt_update()
+        apt("apt-cacher-ng")
+
+    util.sync_templates(env.apt_proxy_templates)
+
+    # pre-seed the cache with everything in APT_REQUIREMENTS_PATH, so that the first host
+    # to be bootstrapped installs at LAN speed too.
+    if env.apt_proxy_host in (env.host, env.host_string):
+        apt_update(0)
+        packages = [name for (name, version) in parse_requirements(env.apt_requirements_path)]
+        sudo("apt-get install -y -q --download-only --reinstall %s" % " ".join(packages))
+
+
+class BatchedResult(object):
+    """
+    The result of a command queued inside a batch().
+
+    The attributes mirror those of fabric's run() and sudo() results, but are only populated
+    once the batch has been shipped, ie. after the batch() block exits. Commands that were
+    never executed because an earlier command failed have a return_code of None.
+    """
+
+    def __init__(self, command, use_sudo, show=True):
+        self.command = command
+        self.use_sudo = use_sudo
+        self.show = show
+        self.warn_only = env.warn_only
+        self.cwd = env.cwd
+        self.prefixes = list(env.command_prefixes)
+        self.stdout = ''
+        self.return_code = None
+
+    @property
+    def failed(self):
+        return self.return_code != 0
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    def __str__(self):
+        return self.stdout
+
+    def script(self):
+        """
+        Return the command as it should be executed inside the batch script.
+        """
+        cmd = " && ".join(
+            (["cd %s" % quote(self.cwd)] if self.cwd else []) + self.prefixes + [self.command])
+        if self.use_sudo and env.user != "root":
+            cmd = "sudo -n sh -c %s" % quote(cmd)
+        return cmd
+
+
+@contextmanager
+def batch():
+    """
+    Queue run() and sudo() calls, and ship them to the remote host as a single script.
+
+    Each call inside the block returns a BatchedResult, which is populated when the block exits;
+    the context value is the list of all of them, in order. As with unbatched commands, the
+    first failing command aborts the batch, unless it was queued with warn_only set. Nested
+    batches are merged into the outermost one.
+    """
+    if getattr(_batch, "queue", None) is not None:
+        yield _batch.queue
+        return
+
+    _batch.queue = queue = []
+    try:
+        yield queue
+    finally:
+        _batch.queue = None
+    _ship(queue)
+
+
+def _ship(queue):
+    """
+    Execute the queued commands in a single remote script, and populate their results.
+    """
+    if not queue:
+        return
+
+    lines = []
+    for (i, r) in enumerate(queue):
+        lines += [
+            "echo '__cotton_begin_%d'" % i,
+            "( %s ) 2>&1" % r.script(),
+            "rc=$?",
+
+            # the output may not end with a newline, so the marker starts with one of its own.
+            "printf '\\n__cotton_end_%d %%s\\n' $rc" % i,
+        ]
+        if not r.warn_only:
+            lines.append("[ $rc -eq 0 ] || exit $rc")
+
+    with settings(hide("running", "output"), warn_only=True, cwd="", command_prefixes=[]):
+        out = frun("\n".join(lines), label="batch")
+
+    for m in BATCH_OUTPUT.finditer(out.replace("\r\n", "\n")):
+        current = queue[int(m.group(1))]
+        current.stdout = m.group(2).rstrip("\n")
+        current.return_code = int(m.group(3))
+        if current.show and current.stdout:
+            print current.stdout
+        if current.failed and not current.warn_only:
+            abort("Batched command failed with return code %s: %s" % (
+                current.return_code, current.command))
+
+    # a command whose end marker never arrived did not complete, eg. the remote shell died.
+    for r in queue:
+        if r.return_code is None and not r.warn_only:
+            abort("Batched command did not complete: %s" % r.command)
 
 
 @task
@@ -151,6 +551,10 @@ def run(command, show=True):
     """
     if show:
         util.print_command(command)
+    if getattr(_batch, "queue", None) is not None:
+        _batch.queue.append(BatchedResult(command, False, show))
+        return _batch.queue[-1]
+    if show:
         with hide("running"):
             return frun(command)
     with hide("running", "output"):
@@ -164,6 +568,10 @@ def sudo(command, show=True):
     """
     if show:
         util.print_command(command)
+    if getattr(_batch, "queue", None) is not None:
+        _batch.queue.append(BatchedResult(command, True, show))
+        return _batch.queue[-1]
+    if show:
         with hide("running"):
             if env.user == "root":
                 return frun(command)
@@ -182,49 +590,207 @@ def apt(packages):
     """
     Installs one or more system packages via apt.
     """
-    return sudo("apt-get install -y -q " + packages)
+    result = sudo("apt-get install -y -q " + packages)
+
+    # the installed package versions are now stale
+    facts.forget()
+    return result
 
 
 @task
+@util.print_header
 def unban_ips(ips=None):
+    """
+    Unban the specified IPs (by default, ADMIN_IPS) from every fail2ban jail
+
+    All of the IPs are handled in a single remote command: each is unbanned through
+    fail2ban-client from whichever jails currently ban it, and the fail2ban log is filtered of
+    all of them in one pass. Returns a dict of {ip: [jails]} for the IPs that were banned.
+    """
 
     if not ips:
         ips = env.all_admin_ips
-    ips = ips.replace(',', ' ')
+    ips = ips.replace(',', ' ').split()
+    if not ips:
+        return {}
+
+    log = "/var/log/fail2ban.log"
+    quoted = " ".join([quote(ip) for ip in ips])
+    cmd = "\n".join([
+        "jails=$(fail2ban-client status 2>/dev/null | sed -n 's/.*Jail list:[[:space:]]*//p' "
+        "| tr ',' ' ')",
+        "for j in $jails; do",
+        "  banned=\" $(fail2ban-client status $j | sed -n 's/.*Banned IP list:[[:space:]]*//p') \"",
+        "  for ip in %s; do" % quoted,
+        '    case "$banned" in *" $ip "*)',
+        '      fail2ban-client set $j unbanip $ip >/dev/null && echo "unbanned $j $ip";;',
+        "    esac",
+        "  done",
+        "done",
+
+        # if fail2ban isn't running, fall back to removing the rules from iptables directly
+        "if [ -z \"$jails\" ]; then for ip in %s; do" % quoted,
+        '  iptables -D fail2ban-ssh -s $ip -j DROP 2>/dev/null && echo "unbanned iptables $ip"',
+        "done; fi",
+
+        # rewrite the log in place (preserving its inode, which fail2ban holds open)
+        "t=$(mktemp)",
+        "grep -v -w -F %s %s > $t; cat $t > %s; rm -f $t" % (
+            " ".join(["-e %s" % quote(ip) for ip in ips]), log, log),
+        "true",
+    ])
+    with hide("output"):
+        out = sudo(cmd, show=False)
+
+    unbanned = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == "unbanned":
+            unbanned.setdefault(parts[2], []).append(parts[1])
+
+    for ip in ips:
+        print "%-40s %s" % (ip, ", ".join(unbanned[ip]) if ip in unbanned else "not banned")
+    return unbanned
+
+
+def _render_rules(rules):
+    """
+    Inject the fabric env into a list of firewall rules, skipping any that cannot be rendered
+    (eg. rules for a module whose settings are not loaded).
+    """
+    rendered = []
+    for r in rules:
+        rule = re.sub(r"%(?!\(\w+\)s)", "%%", r)
+        try:
+            rendered.append(rule % env)
+        except KeyError:
+            continue
+    return rendered
+
+
+def _apt_proxy_rules():
+    """
+    Return the rendered APT_PROXY_FIREWALL rules if the current host serves the apt proxy to
+    APT_PROXY_CLIENTS, otherwise an empty list.
+    """
+    if not getattr(env, 'apt_proxy_clients', None):
+        return []
+    if getattr(env, 'apt_proxy_host', None) not in (env.host, env.host_string):
+        return []
+    return _render_rules(getattr(env, 'apt_proxy_firewall', None) or [])
 
-    for ip in ips.split():
-        sudo("grep -v %s /var/log/fail2ban.log > /tmp/fail2ban.tmp" % ip)
-        sudo("cp /tmp/fail2ban.tmp /var/log/fail2ban.log")
-        with settings(warn_only=True):
-            sudo("iptables -D fail2ban-ssh -s %s -j DROP" % ip, show=False)
+
+def _canonical_rule(rule):
+    """
+    Reduce a ufw rule to a canonical form, so that rules as written in the settings can be
+    compared with rules as reported by 'ufw show added'.
+    """
+    tokens = rule.split()
+    if tokens and tokens[0] == "ufw":
+        tokens = tokens[1:]
+    if not tokens or tokens[0] == "default":
+        return tuple(tokens)
+
+    r = {"action": tokens[0], "direction": "in", "from": "any", "to": "any"}
+    last = "to"
+    rest = tokens[1:]
+    i = 0
+    while i < len(rest):
+        t = rest[i]
+        if t in ("in", "out"):
+            r["direction"] = t
+        elif t in ("log", "log-all"):
+            r["log"] = t
+        elif t in ("proto", "on", "app", "comment", "from", "to") and i + 1 < len(rest):
+            r[t] = rest[i + 1]
+            last = t if t in ("from", "to") else last
+            i += 1
+        elif t == "port" and i + 1 < len(rest):
+            r[last + "_port"] = rest[i + 1]
+            i += 1
+        else:
+            # the simple syntax, eg. 'allow 22/tcp'
+            (port, _, proto) = t.partition("/")
+            r["to_port"] = port
+            if proto:
+                r["proto"] = proto
+        i += 1
+    return tuple(sorted(r.items()))
 
 
 @task
+@util.print_header
 def firewall(firewall=None):
     """
     Configure a default firewall allowing inbound SSH from admin IPs. We use ufw mostly
     because its syntax is more readable than raw iptables, which is a good thing in scripts.
-    """
 
-    # What set of rules should we apply? by default, use the FIREWWALL
-    # variable from settings.
-    if not firewall:
-        firewall = env.firewall
+    The current ruleset is read once, and only the rules that differ are added or deleted, in a
+    single remote command; the firewall is only reloaded if something changed.
 
-    # WAT you could flush existing rules here, to completely wipe out any changes that have
-    # been made. This is a Good Idea, and you should do it. Meaning me,
-    # meaning I should do it.
+    The rules from FIREWALL and (on the apt proxy host) APT_PROXY_FIREWALL are recorded in the
+    journal, and any of them that are later removed from the settings are deleted. The specified
+    rules are only ever added, and rules that cotton did not apply from the settings (including
+    MYSQL_FIREWALL, and anything added by hand) are left alone.
+    """
 
+    # What set of rules should we apply? by default, use the FIREWWALL
+    # variable from settings; any other rules are applied in addition to those.
     util.get_public_ip()
-
-    for r in env.firewall:
-        rule = re.sub(r"%(?!\(\w+\)s)", "%%", r)
-        rule %= env
-        sudo("ufw %s" % rule)
-
-    # WAT we should probably only do this if rules have actually changed.
-    sudo("echo 'y' | ufw enable")
-    sudo("ufw reload")
+    managed = _render_rules(env.firewall)
+    managed += [r for r in _apt_proxy_rules() if r not in managed]
+    desired = list(managed)
+    if firewall and firewall is not env.firewall:
+        desired += [r for r in _render_rules(firewall) if r not in desired]
+
+    # the settings' rules we applied last time; those no longer wanted are ours to delete, so
+    # long as they don't belong to another module.
+    previous = json.loads(journal.load().get("firewall-rules") or "[]")
+    keep = set([_canonical_rule(r) for r in desired + _render_rules(
+        getattr(env, 'mysql_firewall', None) or [])])
+    stale = set([_canonical_rule(r) for r in previous]) - keep
+
+    step = "firewall"
+    inputs = journal.digest(desired, managed)
+    if journal.is_current(step, inputs):
+        print "Firewall rules are unchanged since they were last applied."
+        return []
+
+    with hide("output"):
+        state = sudo("ufw status verbose; echo '== added'; ufw show added", show=False)
+    (status, _, added) = state.partition("== added")
+    active = "Status: active" in status
+
+    # sample: Default: deny (incoming), allow (outgoing), disabled (routed)
+    defaults = {}
+    for line in status.splitlines():
+        if line.startswith("Default:"):
+            for policy in line[len("Default:"):].split(","):
+                (action, _, direction) = policy.strip().partition(" ")
+                defaults[direction.strip("()")] = action
+
+    current = [line.strip() for line in added.splitlines() if line.strip().startswith("ufw ")]
+    current_canonical = set([_canonical_rule(r) for r in current])
+
+    changes = []
+    for rule in desired:
+        tokens = rule.split()
+        if tokens[0] == "default":
+            direction = tokens[2] if len(tokens) > 2 else "incoming"
+            if defaults.get(direction) != tokens[1]:
+                changes.append("ufw " + rule)
+        elif _canonical_rule(rule) not in current_canonical:
+            changes.append("ufw " + rule)
+
+    # add new rules before deleting stale ones, so we never briefly lock ourselves out.
+    changes += ["ufw delete " + r[4:] for r in current if _canonical_rule(r) in stale]
+
+    if active and not changes:
+        print "Firewall rules are up to date."
+    else:
+        sudo(" && ".join(changes + ["ufw reload" if active else "ufw --force enable"]))
+    journal.record_all({step: inputs, "firewall-rules": json.dumps(managed)})
+    return changes
 
 
 # _run and _sudo are wrappers for other submodules to import. We do this to avoid
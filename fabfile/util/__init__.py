@@ -1,36 +1,36 @@
-import re
 import os
-import sys
-from functools import wraps
-from fabric.api import env, hide, sudo, run
-from fabric.contrib.files import exists, upload_template
-from fabric.colors import green, blue, yellow, red
+import time
+import tarfile
+from StringIO import StringIO
+from fabric.api import env, hide
+from fabric.colors import blue, yellow, red
 from copy import copy
 import hashlib
+from . import templating, hashindex
+from .lines import ensure_lines
+from .. import facts, instrument, journal
+from ..instrument import run, sudo, put
 
 
 def add_line_if_missing(target, text):
     """
-    Add the specified text to a target file, if it isn't there already.
+    Add the specified text to a target file, if it isn't there already. Returns True if the
+    file was changed. To ensure several lines at once, use ensure_lines().
 
     WAT: This is slightly dangerous, and not easily undoable, so we probably shouldn't allow it.
     If you need this ability, you probably want a declarative configuration management tool.
     """
-    tempfile = "/tmp/temp_%s" % os.getpid()
-    grep_cmd = 'grep -v "%s" "%s" > %s' % (text, target, tempfile)
-    echo_cmd = 'echo "%s" >> "%s"' % (text, tempfile)
-    mv_cmd = 'mv %s "%s"' % (tempfile, target)
-    sudo("%s && %s && %s" % (grep_cmd, echo_cmd, mv_cmd))
+    return target in ensure_lines([(target, None, text)])
 
 
 def check_shasum(filename, sha):
     """
     Compare the SHA256 checksum of a the specified file against the provided string.
+
+    The file is hashed in chunks, and the digest is remembered in the local hash index, so
+    re-checking an unchanged file costs only a stat().
     """
-    local_sha = hashlib.sha256(open(filename, 'rb').read()).hexdigest()
-    if local_sha != sha:
-        raise Exception
-    return local_sha == sha
+    return hashindex.digest(filename, 'sha256') == sha
 
 
 def print_command(command):
@@ -51,16 +51,12 @@ def printc(text, color=blue):
 
 def print_header(func):
     """
-    Function decorator that displays the function name as a header in the output.
+    Function decorator that displays the function name as a header in the output, and records
+    per-host timings for the call; see instrument.profiled().
 
     Snagged this one from mezzanine's default fabfile. :D
     """
-    @wraps(func)
-    def logged(*args, **kawrgs):
-        header = "-" * len(func.__name__)
-        print(green("\n".join([header, func.__name__, header]), bold=True))
-        return func(*args, **kawrgs)
-    return logged
+    return instrument.profiled(func)
 
 
 def get_templates(templates=None):
@@ -70,38 +66,24 @@ def get_templates(templates=None):
 
     if not templates:
         templates = env.templates
-
-    injected = {}
-    for t in env.templates:
-        name = t['name']
-
-        # Step through the elements of the template dict. If the value is a dict, we inject
-        # the fabric env vars into its members' values, and add the resulting dict to our
-        # return values.  If the template dict item's value is not itself, we treat it as a
-        # string and inject the fabric env vars into it and add that result to our return values.
-        i = {}
-        for k, v in t.items():
-            i[k] = dict([(a, b % env) for a, b in v.items()]) if type(v) is dict else v % env
-        injected[name] = i
-
-    return injected
+    return templating.inject(templates)
 
 
-def upload_template_and_reload(name, templates=None):
+def _resolve_local_path(local_path):
     """
-    Uploads a template only if it has changed, and if so, reload a
-    related service.
+    Locate a template file, falling back to a path relative to cotton itself.
     """
-    template = get_templates(templates)[name]
-    local_path = os.path.abspath(template["local_path"])
+    local_path = os.path.abspath(local_path)
     if not os.path.exists(local_path):
         project_root = os.path.dirname(os.path.abspath(__file__))
         local_path = os.path.join(project_root, local_path)
+    return local_path
 
-    remote_path = template["remote_path"]
-    reload_command = template.get("reload_command")
-    owner = template.get("owner")
-    mode = template.get("mode")
+
+def _template_values(template):
+    """
+    Return the values used to render a template: the current fabric env, plus any extras.
+    """
 
     # populate the values for the template substitution with the current
     # fabric environment
@@ -109,91 +91,207 @@ def upload_template_and_reload(name, templates=None):
 
     # if the template config has an 'extras' dict, step through it and
     # assign the key to the values dict; the value of the new element
-    # can either be a literal or a callable.  If it's a callable, call it.
+    # can either be a literal or a dotted path to a callable, which is
+    # resolved once per host.
     for (k, v) in template.get("extras", {}).items():
+        setattr(values, k, templating.resolve_extra(v))
+
+    return values
+
+
+def render_template(template):
+    """
+    Render a template's local file with the current env, returning (local_path, values, data).
+
+    Renderings are cached by templating.render(), so a template is only rendered once per run
+    unless its file or the env values it references change.
+    """
+    local_path = _resolve_local_path(template["local_path"])
+    values = _template_values(template)
+    return (local_path, values, templating.render(local_path, values))
+
+
+def upload_template_and_reload(name, templates=None):
+    """
+    Uploads a template only if it has changed, and if so, reload a
+    related service.
+    """
+    if not templates:
+        templates = env.templates
+    return name in sync_templates([t for t in templates if t['name'] == name])
 
-        # the value may be a full dotted module path (eg. cotton.fabfile.utils.get_hostname).
-        # If so, check to see if everything up to the last dot is listed in sys.modules. If it is,
-        # it's a module, so check to see if it has a an attribute matching the last portion of the
-        # value. If it does, and it's callable, call it and use the return value for the template
-        # variable, otherwise use the original string.
-        parts = v.split('.')
-        module = sys.modules['.'.join(parts[:-1])]
-        meth = getattr(module, parts[-1:][0], None)
-        setattr(values, k, meth() if meth and callable(meth) else v)
-
-    remote_data = ""
-    if exists(remote_path):
-        with hide("stdout"):
-            remote_data = sudo("cat %s" % remote_path)
-
-    with open(local_path, "r") as f:
-        local_data = f.read()
-        # Escape all non-string-formatting-placeholder occurrences of '%':
-        local_data = re.sub(r"%(?!\(\w+\)s)", "%%", local_data)
-        local_data %= values
-    clean = lambda s: s.replace("\n", "").replace("\r", "").strip()
-
-    # no changes, so no need to rewrite the file
-    if clean(remote_data) == clean(local_data):
+
+def get_remote_hashes(paths):
+    """
+    Return a dict of {path: (mode, sha256)} for each of the specified remote paths that exist.
+
+    All of the paths are hashed in a single remote command, rather than one round trip per file.
+    """
+    if not paths:
+        return {}
+
+    # for every path that exists, emit "<octal mode> <sha256> <path>" on a single line.
+    cmd = (
+        'for f in %s; do [ -f "$f" ] && '
+        'echo "$(stat -c %%a "$f") $(sha256sum < "$f" | cut -d" " -f1) $f"; done; true'
+    ) % " ".join(["'%s'" % p for p in paths])
+    with hide("running", "stdout"):
+        out = sudo(cmd, label="sha256sum")
+
+    hashes = {}
+    for line in out.splitlines():
+        parts = line.strip().split(" ", 2)
+        if len(parts) == 3:
+            hashes[parts[2]] = (parts[0], parts[1])
+    return hashes
+
+
+def pack_files(files):
+    """
+    Return a file-like tarball containing the specified files, to be unpacked at /.
+
+    files is a list of dicts with the keys 'remote_path' and 'data', and optionally 'mode'.
+    """
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode="w")
+    now = time.time()
+    for f in files:
+        info = tarfile.TarInfo(f["remote_path"].lstrip("/"))
+        info.size = len(f["data"])
+        info.mtime = now
+        info.mode = int(str(f.get("mode") or "0644"), 8)
+        tar.addfile(info, StringIO(f["data"]))
+    tar.close()
+    buf.seek(0)
+    return buf
+
+
+def upload_files(files):
+    """
+    Upload a set of files to the remote host in a single transfer.
+
+    files is a list of dicts with the keys 'remote_path' and 'data', and optionally 'mode' and
+    'owner'. The files are packed into a single tarball, uploaded once, and unpacked in place,
+    after which ownership is applied in the same remote command.
+    """
+    if not files:
         return
 
-    # upload the updated file and set its owner/perms, if necessary
-    print "Uploading %s => %s" % (local_path, remote_path)
-    upload_template(local_path, remote_path, values, use_sudo=not env.user == "root", backup=False)
-    if owner:
-        sudo("chown %s %s" % (owner, remote_path))
-    if mode:
-        sudo("chmod %s %s" % (mode, remote_path))
+    # root unpacks this, so it must be a file no other user could have created or replaced.
+    with hide("running", "stdout"):
+        tmp = run("mktemp /tmp/cotton_upload.XXXXXXXXXX").strip()
+    put(pack_files(files), tmp)
 
-    # if there's a reload command, execute it now
-    if reload_command:
-        sudo(reload_command)
+    cmds = ["tar -x --no-same-owner -p -f %s -C /" % tmp, "rm -f %s" % tmp]
+    cmds += ["chown %s '%s'" % (f["owner"], f["remote_path"]) for f in files if f.get("owner")]
+    sudo(" && ".join(cmds))
 
 
-def upload_all_templates(templates=None):
+def sync_templates(templates=None):
     """
-    Upload all configured templates and reload the related services.
+    Upload all changed templates in a single transfer, and reload each affected service once.
+
+    Rather than comparing each template with the remote file in turn, the remote files are hashed
+    in one command and compared against the locally rendered templates; only those that differ
+    are uploaded. Returns the list of template names that were changed.
+
+    Templates whose rendering was the last applied to their remote path are not checked at
+    all; see journal.
     """
     if not templates:
         templates = env.templates
 
-    for template in templates:
-        n = template['name']
-        upload_template_and_reload(n)
+    # each remote file has its own journal entry, so that syncing some templates never hides
+    # changes from a later sync of others.
+    rendered = []
+    steps = {}
+    for template in get_templates(templates).values():
+        (local_path, values, data) = render_template(template)
+        step = "template-" + journal.digest(template["remote_path"])[:12]
+        inputs = journal.digest(
+            template["remote_path"], hashlib.sha256(data).hexdigest(), template.get("mode"),
+            template.get("owner"), template.get("reload_command"))
+        if not journal.is_current(step, inputs):
+            rendered.append((template, local_path, data))
+            steps[step] = inputs
+    if not rendered:
+        return []
+
+    remote = get_remote_hashes([t["remote_path"] for (t, l, d) in rendered])
+
+    changed = []
+    reloads = []
+    files = []
+    for (template, local_path, data) in rendered:
+        remote_path = template["remote_path"]
+        (remote_mode, remote_sha) = remote.get(remote_path, (None, None))
+        if remote_sha == hashlib.sha256(data).hexdigest():
+            continue
+
+        print "Uploading %s => %s" % (local_path, remote_path)
+        files.append({
+            "remote_path": remote_path,
+            "data": data,
+
+            # preserve the existing file mode, unless the template specifies one
+            "mode": template.get("mode") or remote_mode,
+            "owner": template.get("owner"),
+        })
+        changed.append(template["name"])
+
+        # services with several changed templates need only be reloaded once
+        reload_command = template.get("reload_command")
+        if reload_command and reload_command not in reloads:
+            reloads.append(reload_command)
+
+    upload_files(files)
+    for reload_command in reloads:
+        sudo(reload_command)
+
+    journal.record_all(steps)
+    return changed
+
+
+def upload_all_templates(templates=None):
+    """
+    Upload all configured templates and reload the related services.
+    """
+    return sync_templates(templates)
 
 
 def get_iface_for_subnet(subnet):
     """
     Return the NIC on which the specified subnet is configured.
     """
-    subnet = subnet.replace('.', '\\.')
-    cmd = "/sbin/ifconfig | grep -B1 'inet addr:%s' | cut -d' ' -f1" % subnet
-    return sudo(cmd)
+    for (iface, addrs) in facts.get()['interfaces'].items():
+        if [a for a in addrs['ipv4'] if a.startswith(subnet)]:
+            return iface
 
 
 def get_ipv4(iface):
     """
     Return the IPv4 address assigned to the specified NIC.
     """
-    cmd = "/sbin/ifconfig %s | grep 'inet addr:' | cut -d: -f 2 |cut -d' ' -f1" % iface
-    return sudo(cmd)
+    addrs = facts.get()['interfaces'].get(iface, {}).get('ipv4', [])
+    return addrs[0].split('/')[0] if addrs else None
 
 
 def get_hostname():
     """
     Return the host's name
     """
-    cmd = "hostname"
-    return run(cmd)
+    return facts.get()['hostname']
 
 
-def get_public_ip(iface='eth0'):
+def get_public_ip(iface=None):
     """
     Return the IP of the primary public interface.
-    """
 
-    # WAT bad assumption here; we should make this configurable by adding a MANAGED_IFACE to the
-    # settings or something.
-    env.public_ip = get_ipv4(iface)
+    This is the interface named by PUBLIC_IFACE in the settings, if any, otherwise the interface
+    carrying the host's default route.
+    """
+    if iface:
+        env.public_ip = get_ipv4(iface)
+    else:
+        facts.get()
     return env.public_ip
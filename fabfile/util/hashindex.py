@@ -0,0 +1,75 @@
+"""
+Streaming file hashing, backed by a persistent local index of known digests.
+
+The index maps each path to the (size, mtime, inode) it had when hashed, along with its digests,
+so verifying an unchanged artifact costs a single stat() call.
+"""
+import os
+import json
+import hashlib
+from fabric.api import env
+
+CHUNK_SIZE = 1024 * 1024
+
+_index = None
+
+
+def _index_path():
+    root = os.path.expanduser(getattr(env, 'cotton_cache_path', None) or '~/.cotton')
+    return os.path.join(root, 'hashes.json')
+
+
+def _load():
+    global _index
+    if _index is None:
+        _index = {}
+        path = _index_path()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                try:
+                    _index = json.load(f)
+                except ValueError:
+                    pass
+    return _index
+
+
+def _save():
+    path = _index_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    # write atomically, so concurrent cotton runs never see a truncated index
+    tmp = "%s.%s" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(_index, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def stream_digest(filename, algorithm='sha256'):
+    """
+    Hash the specified file in fixed-size chunks, without reading it all into memory.
+    """
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest(filename, algorithm='sha256'):
+    """
+    Return the digest of the specified file, using the index if the file is unchanged since
+    it was last hashed.
+    """
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    key = [st.st_size, st.st_mtime, st.st_ino]
+
+    index = _load()
+    entry = index.get(path)
+    if not entry or entry['stat'] != key:
+        entry = index[path] = {'stat': key, 'digests': {}}
+    if algorithm not in entry['digests']:
+        entry['digests'][algorithm] = stream_digest(path, algorithm)
+        _save()
+    return entry['digests'][algorithm]
@@ -0,0 +1,84 @@
+"""
+Ensure the presence of lines in remote files, in bulk.
+"""
+import re
+import json
+import base64
+from fabric.api import hide
+from ..instrument import sudo
+
+# Executed on the remote host with RULES substituted; streams each target file once, applying
+# every rule for that file, and atomically replaces it only if something changed. Prints a JSON
+# list of the files that were changed.
+SCRIPT = r"""
+import base64, json, os, re, tempfile
+rules = json.loads(base64.b64decode('%(rules)s').decode('utf-8'))
+changed = []
+for target in sorted(rules):
+    compiled = [(re.compile(p), line) for (p, line) in rules[target]]
+    placed = [False] * len(compiled)
+    dirty = False
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or '.', prefix='.cotton-')
+    out = os.fdopen(fd, 'w')
+    last = '\n'
+    if os.path.exists(target):
+        for l in open(target):
+            stripped = l.rstrip('\n')
+            for (i, (rx, line)) in enumerate(compiled):
+                if rx.search(stripped):
+                    if placed[i]:
+                        dirty = True
+                    else:
+                        placed[i] = True
+                        dirty = dirty or stripped != line
+                        out.write(line + '\n')
+                        last = '\n'
+                    break
+            else:
+                out.write(l)
+                last = l[-1:]
+    for (i, (rx, line)) in enumerate(compiled):
+        if not placed[i]:
+            out.write(('' if last == '\n' else '\n') + line + '\n')
+            last = '\n'
+            dirty = True
+    out.close()
+    if dirty:
+        if os.path.exists(target):
+            st = os.stat(target)
+            os.chmod(tmp, st.st_mode & 0o7777)
+            os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, 0o644)
+        os.rename(tmp, target)
+        changed.append(target)
+    else:
+        os.unlink(tmp)
+print(json.dumps(changed))
+"""
+
+
+def ensure_lines(rules):
+    """
+    Ensure lines are present in remote files, returning the list of files that were changed.
+
+    rules is a list of (target, pattern, line) tuples. In each target file, the first line
+    matching the regular expression pattern is replaced with line, and any further matching
+    lines are removed; if no line matches, line is appended. If pattern is None, lines
+    containing the literal text of line are matched.
+
+    All of the rules are applied on the remote host in a single command, with one pass over
+    each target file; files are only rewritten (atomically, preserving owner and mode) if
+    their contents actually change.
+    """
+    grouped = {}
+    for (target, pattern, line) in rules:
+        grouped.setdefault(target, []).append((pattern or re.escape(line), line))
+    if not grouped:
+        return []
+
+    script = SCRIPT % {'rules': base64.b64encode(json.dumps(grouped))}
+    cmd = "$(command -v python3 || command -v python) - <<'EOF'\n%s\nEOF" % script
+    with hide("running", "stdout"):
+        out = sudo(cmd, label="ensure_lines")
+    return json.loads(out.strip().splitlines()[-1])
@@ -0,0 +1,119 @@
+"""
+A small caching layer over cotton's %-style templates.
+
+Each template file is compiled (read, escaped and scanned for placeholders) once per run and
+recompiled only if its mtime changes. Rendered output is cached against a fingerprint of just the
+env values the template actually references, so the same rendering can be used both to diff
+against the remote file and as the upload payload.
+"""
+import re
+import os
+import sys
+import hashlib
+from fabric.api import env
+
+PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+ESCAPE = re.compile(r"%%|%(?!\(\w+\)s)")
+
+# path => (mtime, escaped text, placeholder names)
+_compiled = {}
+
+# (path, mtime, fingerprint) => rendered text
+_rendered = {}
+
+# (host_string, dotted path) => resolved value
+_extras = {}
+
+# id(templates) => (templates, placeholder names, {fingerprint: injected templates})
+_injected = {}
+
+
+def fingerprint(values, names):
+    """
+    Return a digest of the values of the named keys; this changes iff the rendering would.
+    """
+    h = hashlib.sha1()
+    for name in sorted(set(names)):
+        h.update("%s=%r\0" % (name, values.get(name)))
+    return h.hexdigest()
+
+
+def compile_template(path):
+    """
+    Return (mtime, text, names) for the template at path, compiling it if necessary.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _compiled.get(path)
+    if cached and cached[0] == mtime:
+        return cached
+
+    with open(path, "r") as f:
+        text = f.read()
+
+    # Escape all non-string-formatting-placeholder occurrences of '%', leaving '%%' alone so
+    # that it renders as a literal '%', just as it did with fabric's upload_template():
+    text = ESCAPE.sub("%%", text)
+    _compiled[path] = (mtime, text, PLACEHOLDER.findall(text))
+    return _compiled[path]
+
+
+def render(path, values):
+    """
+    Render the template at path with the specified values, reusing a previous rendering if
+    neither the file nor any of the values it references have changed.
+    """
+    (mtime, text, names) = compile_template(path)
+    key = (path, mtime, fingerprint(values, names))
+    if key not in _rendered:
+        _rendered[key] = text % values
+    return _rendered[key]
+
+
+def resolve_extra(value):
+    """
+    Resolve a template 'extras' value, calling it at most once per host.
+
+    The value may be a full dotted module path (eg. cotton.fabfile.utils.get_hostname).
+    If so, check to see if everything up to the last dot is listed in sys.modules. If it is,
+    it's a module, so check to see if it has a an attribute matching the last portion of the
+    value. If it does, and it's callable, call it and use the return value for the template
+    variable, otherwise use the original string.
+    """
+    key = (env.host_string, value)
+    if key not in _extras:
+        parts = value.split('.')
+        module = sys.modules.get('.'.join(parts[:-1]))
+        meth = getattr(module, parts[-1], None) if module else None
+        _extras[key] = meth() if meth and callable(meth) else value
+    return _extras[key]
+
+
+def inject(templates):
+    """
+    Returns each of the templates with env vars injected, keyed by name.
+
+    The result is cached for as long as the env values referenced by the templates are unchanged,
+    so repeated lookups by name are cheap.
+    """
+    cached = _injected.get(id(templates))
+    if not cached or cached[0] is not templates:
+        cached = (templates, PLACEHOLDER.findall(repr(templates)), {})
+        _injected[id(templates)] = cached
+
+    key = fingerprint(env, cached[1])
+    if key not in cached[2]:
+        injected = {}
+        for t in templates:
+
+            # Step through the elements of the template dict. If the value is a dict, we inject
+            # the fabric env vars into its members' values, and add the resulting dict to our
+            # return values.  If the template dict item's value is not itself, we treat it as a
+            # string and inject the fabric env vars into it and add that result to our return
+            # values.
+            i = {}
+            for k, v in t.items():
+                i[k] = dict([(a, b % env) for a, b in v.items()]) if type(v) is dict else v % env
+            injected[t['name']] = i
+        cached[2][key] = injected
+
+    return cached[2][key]
@@ -5,7 +5,7 @@ import os
 COTTON_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 # import the default settings for submodules, if any
-module_list = os.environ.get('COTTON_LIBS', 'system,project,postfix,mysql,iojs')
+module_list = os.environ.get('COTTON_LIBS', 'system,project,postfix,mysql,iojs,fleet')
 for module in module_list.split(','):
     try:
         exec("from %s import *" % module) in locals()
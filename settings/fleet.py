@@ -0,0 +1,17 @@
+# Defaults for fleet.rollout(); each may be overridden by the task's arguments.
+
+# The number of hosts a rollout works on at once.
+FLEET_CONCURRENCY = 10
+
+# The size of each rolling batch, as a number of hosts or a percentage string (eg. '25%').
+# None means the whole fleet is a single batch.
+FLEET_BATCH = None
+
+# Stop the rollout as soon as any host has failed; hosts already running are left to finish.
+FLEET_FAIL_FAST = False
+
+# Stop the rollout once more than this many hosts (or this percentage of them) have failed.
+FLEET_MAX_FAILURES = None
+
+# Kill any host's task that has been running longer than this many seconds; 0 disables.
+FLEET_TIMEOUT = 0
@@ -16,7 +16,7 @@ MYSQL_MAX_ALLOWED_PACKET = '16M'
 MYSQL_KEY_BUFFER = '16M'
 
 MYSQL_FIREWALL = [
-    'allow proto tcp from %(all_admin_ips)s to %s port %(mysql_port)s',
+    'allow proto tcp from %(all_admin_ips)s to %(public_ip)s port %(mysql_port)s',
 ]
 
 # you must specify this in your local cotton_settings, and it must be unique
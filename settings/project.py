@@ -24,6 +24,57 @@ PROJECT_GROUP = None
 PIP_REQUIREMENTS_PATH = [COTTON_PATH + '/requirements/pip.txt']
 APT_REQUIREMENTS_PATH = [COTTON_PATH + '/requirements/apt.txt']
 
-# Use git for shipping application code to the remote hosts
+# Build the PIP_REQUIREMENTS_PATH requirements into wheels once, on WHEELHOUSE_BUILDER (a host
+# string) or locally if it is None, and install them on each host from a shipped wheelhouse
+# rather than from the package index.
+PIP_WHEELHOUSE = False
+WHEELHOUSE_BUILDER = None
+
+# Keep a cache of virtualenvs on each host, keyed by python version and requirements, from which
+# project.create can clone a new virtualenv instead of building it and installing everything
+# again; eg. VIRTUALENV_CACHE = '/usr/local/deploy/.virtualenv-cache'. Clones are copy-on-write
+# where the filesystem supports it; VIRTUALENV_CACHE_LINK hardlinks them instead, which is only
+# safe if nothing modifies installed packages in place.
+VIRTUALENV_CACHE = None
+VIRTUALENV_CACHE_LINK = False
+
+# Use git for shipping application code to the remote hosts. If False, code is shipped as a
+# file tree (see project.ship_artifact): ARTIFACT_PATH, a local directory such as the output of
+# a build, or a git archive of GIT_BRANCH if it is None.
 USE_GIT = True
 GIT_BRANCH = 'master'
+ARTIFACT_PATH = None
+
+# When shipping with project.distribute, each host that has received the new revision relays it
+# to up to this many others.
+GIT_FANOUT = 4
+
+# Deploy each revision into its own directory under VIRTUALENV_PATH/releases, and make
+# PROJECT_ROOT a symlink to the active one, switched atomically once the release is complete.
+# Revisions are pushed to a bare repository at VIRTUALENV_PATH/repo.git. Rollbacks
+# (project.rollback) only switch the symlink, so old releases are kept around for them.
+USE_RELEASES = False
+KEEP_RELEASES = 5
+
+# Share git objects between all of the projects on a host, through a bare repository at this
+# path that every project repository uses as an alternate object store; eg.
+# GIT_SHARED_OBJECTS = '/usr/local/deploy/.git-objects'. The store and the project repositories
+# are repacked by cron (as SSH_USER) on GIT_GC_SCHEDULE, or on demand with project.gc.
+GIT_SHARED_OBJECTS = None
+GIT_GC_SCHEDULE = '17 4 * * *'
+GIT_GC_TEMPLATES = [
+    {
+        "name": "git_gc",
+        "local_path": COTTON_PATH + "/templates/git_gc",
+        "remote_path": "/usr/local/sbin/cotton-git-gc",
+        "owner": "root",
+        "mode": "0755",
+    },
+    {
+        "name": "git_gc_cron",
+        "local_path": COTTON_PATH + "/templates/git_gc_cron",
+        "remote_path": "/etc/cron.d/cotton-git-gc",
+        "owner": "root",
+        "mode": "0644",
+    },
+]
@@ -3,6 +3,23 @@ import os
 # The local path to cotton -- used for locating and loading submodules, templates, etc.
 COTTON_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
+# Where each host records the inputs of the steps applied to it, so unchanged steps can be
+# skipped. Set FORCE (eg. fab --set force=1 ...) to re-apply every step regardless.
+JOURNAL_PATH = '/var/lib/cotton/journal'
+FORCE = False
+
+# If set, write per-task, per-host timings to PROFILE_PATH.json and PROFILE_PATH.folded.
+PROFILE_PATH = None
+
+# Where cotton keeps local state (cached host facts and the like).
+COTTON_CACHE_PATH = '~/.cotton'
+
+# How long, in seconds, cached host facts remain valid before they are gathered again.
+FACTS_TTL = 3600
+
+# The interface whose address is used as public_ip; defaults to that of the default route.
+PUBLIC_IFACE = None
+
 # Note: may be platform-dependant!
 LOCALE = 'en_US.UTF-8'
 
@@ -20,6 +37,10 @@ SSH_USER = 'deploy'
 SSH_PASS = None
 SSH_KEY_PATH = '~/.ssh/id_rsa'
 
+# Local git/scp/rsync invocations share one OpenSSH connection per host; this is how long that
+# connection lingers after the last use.
+SSH_CONTROL_PERSIST = '10m'
+
 # the accounts that should be created in the staff group and granted sudo access.
 # We default to a single 'deploy' user so other projects that are deploying via
 # fabric to our host(s) do not need root access.
@@ -47,9 +68,37 @@ TEMPLATES = [
 ]
 
 # list all services that should be running here; each member of the list should be the name
-# of a sysvinit script that can respond to the start and status commands.
+# of a sysvinit script that can respond to the start and status commands, or a dict naming the
+# script and a readiness probe, eg. {'name': 'mysql', 'port': 3306, 'timeout': 60}. See
+# system.ensure_running() for the available probes.
 
 # disabling fail2ban until I can determine why it fails to ignore ADMIN_IPS
 #ENSURE_RUNNING = ['fail2ban', 'ntp']
 
 ENSURE_RUNNING = ['ntp']
+
+# The number of independent bootstrap steps that may run at once on each host.
+BOOTSTRAP_CONCURRENCY = 4
+
+# Skip 'apt-get update' if the package lists were updated less than this many seconds ago.
+APT_UPDATE_MAX_AGE = 6 * 3600
+
+# If set, this host runs apt-cacher-ng, and every other host fetches its packages through it.
+# Bootstrap the proxy host before the rest of the fleet. APT_PROXY_CLIENTS, if set, is the
+# address or subnet permitted to use the cache.
+APT_PROXY_HOST = None
+APT_PROXY_PORT = 3142
+APT_PROXY_CLIENTS = None
+
+# Firewall rules applied (by system.firewall) on the proxy host when APT_PROXY_CLIENTS is set.
+APT_PROXY_FIREWALL = [
+    "allow proto tcp from %(apt_proxy_clients)s to any port %(apt_proxy_port)s",
+]
+
+APT_PROXY_TEMPLATES = [
+    {
+        "name": "apt_proxy",
+        "local_path": COTTON_PATH + "/templates/apt_proxy",
+        "remote_path": "/etc/apt/apt.conf.d/01cotton-proxy",
+    },
+]
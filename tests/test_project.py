@@ -0,0 +1,147 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from subprocess import check_call, check_output
+
+from fabfile import project
+
+
+class RequirementsRoundTripTest(unittest.TestCase):
+    """
+    Run the requirements script against local files, the way read_requirements() runs it on the
+    remote host, and check that what install_dependencies() records reads back unchanged.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.applied = os.path.join(self.root, ".cotton-requirements")
+        self.paths = [os.path.join(self.root, "a.txt"), os.path.join(self.root, "b.txt")]
+
+        # neither file ends in a newline.
+        with open(self.paths[0], "w") as f:
+            f.write("Django==1.8\nrequests>=2.0")
+        with open(self.paths[1], "w") as f:
+            f.write("# comment\nsix")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self):
+        script = project._requirements_script(
+            self.paths, self.applied, freeze="printf 'Django==1.8\\nrequests==2.1\\nsix==1.9\\n'",
+            requires="echo '__cotton_requires django six'")
+
+        # fabric strips the output of remote commands
+        out = check_output(["sh", "-c", script]).strip()
+        return project._parse_requirements_state(out)
+
+    def record(self, files):
+        current = "\n".join([contents for (fn, contents) in files])
+        with open(self.applied, "w") as f:
+            f.write(current + "\n")
+        return current
+
+    def test_first_run(self):
+        (installed, files, applied, required) = self.read()
+        self.assertEqual(installed, {"django": "1.8", "requests": "2.1", "six": "1.9"})
+        self.assertEqual(required, {"six": set(["django"])})
+        self.assertEqual(files, [
+            (self.paths[0], "Django==1.8\nrequests>=2.0"),
+            (self.paths[1], "# comment\nsix"),
+        ])
+        self.assertEqual(applied, "")
+
+    def test_recorded_requirements_read_back_unchanged(self):
+        current = self.record(self.read()[1])
+        (installed, files, applied, required) = self.read()
+        self.assertEqual([fn for (fn, contents) in files], self.paths)
+        self.assertEqual(applied, current)
+        self.assertEqual(project._requirements_delta(installed, current, applied), ([], []))
+
+    def test_delta(self):
+        self.record(self.read()[1])
+        with open(self.paths[0], "w") as f:
+            f.write("Django==1.9\n")
+        (installed, files, applied, required) = self.read()
+        current = "\n".join([contents for (fn, contents) in files])
+        self.assertEqual(project._requirements_delta(installed, current, applied, required),
+                         (["Django==1.9"], ["requests"]))
+
+    def test_dependencies_are_not_removed(self):
+        self.record(self.read()[1])
+        with open(self.paths[1], "w") as f:
+            f.write("# comment\n")
+        (installed, files, applied, required) = self.read()
+        current = "\n".join([contents for (fn, contents) in files])
+        self.assertEqual(project._requirements_delta(installed, current, applied, required),
+                         ([], []))
+
+        # without django, nothing needs six any more.
+        self.assertEqual(project._requirements_delta(installed, "", applied, required),
+                         ([], ["django", "requests", "six"]))
+
+    def test_parse_requirements(self):
+        (requirements, other) = project._parse_requirements(
+            "Django==1.8  # pinned\n\n# comment\n-r other.txt\n-e git+https://x/y.git#egg=y\nsix")
+        self.assertEqual(sorted(requirements), ["django", "six"])
+        self.assertEqual(str(requirements["django"]), "Django==1.8")
+        self.assertEqual(other, ["-r other.txt", "-e git+https://x/y.git#egg=y"])
+
+
+class ReleaseBuildTest(unittest.TestCase):
+    """
+    Build consecutive release directories with the commands activate_release() runs remotely.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, "src")
+        self.repo = os.path.join(self.root, "repo.git")
+        self.releases = os.path.join(self.root, "releases")
+        os.makedirs(self.releases)
+        check_call(["git", "init", "-q", self.src])
+        check_call(["git", "init", "-q", "--bare", self.repo])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def commit(self, files):
+        for (name, data) in files.items():
+            with open(os.path.join(self.src, name), "w") as f:
+                f.write(data)
+        check_call(["git", "-C", self.src, "add", "-A"])
+        check_call(["git", "-C", self.src, "-c", "user.name=cotton", "-c",
+                    "user.email=cotton@localhost", "commit", "-q", "-m", "release"])
+        check_call(["git", "-C", self.src, "push", "-q", self.repo, "HEAD:refs/heads/master"])
+        return check_output(["git", "-C", self.src, "rev-parse", "HEAD"]).strip()
+
+    def build(self, sha, prev=None):
+        check_call(["sh", "-c", project._release_script(self.releases, self.repo, sha, prev)])
+        path = os.path.join(self.releases, sha)
+        os.rename(path + ".tmp", path)
+        return path
+
+    def test_consecutive_releases(self):
+        first = self.build(self.commit({"a.txt": "a\n", "b.txt": "b\n"}))
+
+        # the permissions sweep changes the ctime of every file in the release.
+        time.sleep(1.1)
+        for name in os.listdir(first):
+            os.chmod(os.path.join(first, name), 0o664)
+
+        sha = self.commit({"a.txt": "a2\n", "c.txt": "c\n"})
+        second = self.build(sha, os.path.basename(first))
+
+        self.assertEqual(open(os.path.join(first, "a.txt")).read(), "a\n")
+        self.assertEqual(open(os.path.join(second, "a.txt")).read(), "a2\n")
+        self.assertEqual(sorted(os.listdir(second)), ["a.txt", "b.txt", "c.txt"])
+        self.assertEqual(os.stat(os.path.join(first, "b.txt")).st_ino,
+                         os.stat(os.path.join(second, "b.txt")).st_ino)
+        self.assertNotEqual(os.stat(os.path.join(first, "a.txt")).st_ino,
+                            os.stat(os.path.join(second, "a.txt")).st_ino)
+
+
+if __name__ == "__main__":
+    unittest.main()